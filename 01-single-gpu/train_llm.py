@@ -1,23 +1,33 @@
 import argparse
+import collections
+import copy
 from itertools import chain
 import json
 import multiprocessing
 import os
+import queue
+import random
+import shutil
+import threading
 import time
 from pathlib import Path
 import logging
 
+import numpy as np
 import torch
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 import wandb
 import tqdm
 import datasets
+from datasets.distributed import split_dataset_by_node
 from transformers import (
     AutoConfig,
     AutoModelForCausalLM,
     AutoTokenizer,
     default_data_collator,
 )
+from transformers.models.llama.modeling_llama import LlamaDecoderLayer
 
 LOGGER = logging.getLogger(__name__)
 
@@ -25,6 +35,8 @@ LOGGER = logging.getLogger(__name__)
 def main():
     parser = _get_parser()
     args = parser.parse_args()
+    if args.ckpt_keep_last < 1:
+        parser.error("--ckpt-keep-last has to keep at least the newest checkpoint.")
 
     # Will be modifying this in future version to include rank information
     logging.basicConfig(
@@ -36,9 +48,16 @@ def main():
     LOGGER.info(os.environ)
     LOGGER.info(args)
 
-    # This guide assumes CUDA device is available, and does all training in bf16
+    # This guide assumes CUDA device is available, and does all training in bf16 by default
     device = torch.device("cuda")
-    dtype = torch.bfloat16
+    dtypes = {"bf16": torch.bfloat16, "fp32": torch.float32}
+    # NOTE: the model (and so the optimizer) keeps its weights in `dtype`, and autocast runs
+    #       forward & backward in `param_dtype`. E.g. `--master-dtype fp32 --param-dtype bf16`
+    #       is the usual mixed precision setup.
+    dtype = dtypes[args.master_dtype]
+    param_dtype = dtypes[args.param_dtype or args.master_dtype]
+    if param_dtype.itemsize > dtype.itemsize:
+        raise ValueError("autocast can't run in higher precision than --master-dtype.")
 
     # Seed pytorch's RNG. See https://pytorch.org/docs/stable/notes/randomness.html
     torch.manual_seed(args.seed)
@@ -49,18 +68,57 @@ def main():
         model = AutoModelForCausalLM.from_config(config, torch_dtype=dtype)
     LOGGER.info(f"{sum(p.numel() for p in model.parameters())} model parameters")
 
-    train_data = _load_and_preprocess_data(args, config)
+    # NOTE: flash_attention_2 keeps packed documents apart by itself, using the position ids.
+    document_mask = model.config._attn_implementation != "flash_attention_2"
+
+    if args.buffer_dtype is not None:
+        for buffer in model.buffers():
+            if buffer.is_floating_point():
+                buffer.data = buffer.data.to(dtypes[args.buffer_dtype])
+
+    if args.compile == "on":
+        _compile_decoder_layers(model, cache_dir=args.compile_cache_dir)
+
+    if args.streaming == "on":
+        # NOTE: streaming reads its own part of the data on the fly, so there is nothing to download first.
+        train_data = StreamingPackedDataset(
+            args,
+            rank=0,
+            num_replicas=1,
+            num_blocks=args.steps_per_epoch * args.batch_size * args.grad_accum,
+        )
+    else:
+        train_data = _load_and_preprocess_data(args, config)
     LOGGER.info(f"{len(train_data)} training samples")
 
     # Standard pytorch dataset iterator
     dataloader = DataLoader(
         train_data,
         batch_size=args.batch_size,
-        shuffle=True,
         drop_last=True,
-        collate_fn=default_data_collator,
+        # NOTE: Seeded shuffling (instead of shuffle=True), so we can resume part way through an epoch.
+        sampler=(
+            None
+            if isinstance(train_data, StreamingPackedDataset)
+            else ResumableDistributedSampler(
+                train_data,
+                batch_size=args.batch_size,
+                num_replicas=1,
+                rank=0,
+                shuffle=True,
+                seed=args.seed,
+            )
+        ),
+        collate_fn=(
+            packed_data_collator
+            if isinstance(train_data, (PackedDataset, StreamingPackedDataset))
+            else default_data_collator
+        ),
+        pin_memory=True,
     )
     LOGGER.info(f"{len(dataloader)} batches per epoch")
+    # NOTE: a step is one optimizer update, which takes `--grad-accum` batches.
+    steps_per_epoch = len(dataloader) // args.grad_accum
 
     optimizer = torch.optim.AdamW(model.parameters(), lr=args.lr, fused=True)
 
@@ -80,16 +138,22 @@ def main():
         "running_loss": 0,
     }
     resumed = False
-    if (exp_dir / "state.json").exists():
+    ckpt_dir = _get_latest_checkpoint(exp_dir / "checkpoints")
+    if ckpt_dir is not None:
+        LOGGER.info(f"Resuming from {ckpt_dir}")
+
         # NOTE: weights_only is to protect against arbitrary code execution with pickle decoding.
         def _load_to_device(p):
             return torch.load(p, map_location=device, weights_only=True)
 
-        model.load_state_dict(_load_to_device(exp_dir / "model.pt"))
-        optimizer.load_state_dict(_load_to_device(exp_dir / "optimizer.pt"))
-        lr_scheduler.load_state_dict(_load_to_device(exp_dir / "lr_scheduler.pt"))
-        with open(exp_dir / "state.json") as fp:
+        model.load_state_dict(_load_to_device(ckpt_dir / "model.pt"))
+        optimizer.load_state_dict(_load_to_device(ckpt_dir / "optimizer.pt"))
+        lr_scheduler.load_state_dict(_load_to_device(ckpt_dir / "lr_scheduler.pt"))
+        with open(ckpt_dir / "state.json") as fp:
             state = json.load(fp)
+        if isinstance(train_data, StreamingPackedDataset):
+            with open(ckpt_dir / "data.json") as fp:
+                train_data.load_state_dict(json.load(fp))
         resumed = True
     LOGGER.info(f"Resumed={resumed} | {state}")
 
@@ -112,64 +176,128 @@ def main():
     )
 
     # will be using to understand breakdown of speed
-    timers = {k: LocalTimer(device) for k in ["data", "forward", "backward", "update"]}
+    # NOTE: the backward pass does twice the matmuls of the forward pass (the gradients of both
+    #       the inputs & the weights).
+    flops_per_token = 3 * get_flops_per_token(config, args.seq_length)["total"]
+    hardware_flops_per_token = flops_per_token
+
+    timers = {
+        k: LocalTimer(device, sync=args.timer_mode == "sync")
+        for k in ["data", "forward", "backward", "update"]
+    }
+    # NOTE: calling .item() on the loss every step would make the CPU wait for the GPU, so we
+    #       accumulate on the GPU and only copy it back when logging/checkpointing.
+    running_loss = torch.tensor(
+        state["running_loss"], dtype=torch.float32, device=device
+    )
+
+    # NOTE: with --compile on, the first step also compiles the model. We time it on its own.
+    compile_ms = None
+    compile_start = None
 
     for state["epoch"] in range(state["epoch"], args.num_epochs):
         LOGGER.info(f"Begin epoch {state['epoch']} at step {state['epoch_step']}")
 
-        progress_bar = tqdm.tqdm(range(len(dataloader)))
+        progress_bar = tqdm.tqdm(range(steps_per_epoch))
         if state["epoch_step"] > 0:
             progress_bar.update(state["epoch_step"])
 
         # NOTE: This is not standard. Normally you can just iterate directly over dataloader.
         #       We are doing this so we can explicitly measure the time it takes to generate a batch.
-        batches = iter(dataloader)
+        # NOTE: start_step makes the sampler skip the batches we already trained on when resuming,
+        #       so we never load them. state["epoch"] & state["epoch_step"] are the sampler's position.
+        #       A streaming dataset keeps track of its own position instead.
+        if not isinstance(train_data, StreamingPackedDataset):
+            dataloader.sampler.set_epoch(
+                state["epoch"], start_step=state["epoch_step"] * args.grad_accum
+            )
+        # NOTE: copies the next batches to the GPU while we are still computing the current one.
+        batches = DevicePrefetcher(dataloader, device, num_batches=args.device_prefetch)
+
+        for i_step in range(state["epoch_step"], steps_per_epoch):
+            if args.compile == "on" and compile_ms is None:
+                torch.cuda.synchronize(device)
+                compile_start = time.time()
 
-        for i_step in range(len(dataloader)):
             # Here we measure the time it takes to generate a batch and move it to the GPU
             with timers["data"], torch.no_grad():
-                batch = next(batches)
-                batch = {k: v.to(device=device) for k, v in batch.items()}
-
-            # For resuming, this has to come after getting the next batch, so we move through the dataset properly.
-            if i_step < state["epoch_step"]:
-                # NOTE: for resuming
-                continue
-
-            with timers["forward"]:
-                outputs = model(**batch)
-
-            with timers["backward"]:
-                # NOTE: set_to_none=True will de-allocate the gradients, saving us some memory.
-                optimizer.zero_grad(set_to_none=True)
-                outputs.loss.backward()
+                micro_batches = [next(batches) for _ in range(args.grad_accum)]
+                for batch in micro_batches:
+                    if "data_state" in batch:
+                        train_data.update_state(batch.pop("data_state"))
+                # NOTE: the loss is averaged over the tokens the model predicts, and micro batches
+                #       can have different numbers of those, so we weight each one by its share.
+                num_targets = [
+                    (b["labels"][:, 1:] != -100).sum() for b in micro_batches
+                ]
+                total_targets = sum(num_targets)
+
+            for i_micro, batch in enumerate(micro_batches):
+                with timers["forward"], torch.autocast(
+                    device.type, dtype=param_dtype, enabled=param_dtype != dtype
+                ):
+                    if document_mask:
+                        batch = _with_document_mask(batch, dtype=param_dtype)
+                    outputs = model(**batch)
+
+                with timers["backward"]:
+                    # NOTE: backward() adds to the existing gradients, so this accumulates them.
+                    loss = outputs.loss * num_targets[i_micro] / total_targets
+                    loss.backward()
+
+                running_loss += loss.detach()
 
             with timers["update"]:
                 optimizer.step()
                 lr_scheduler.step()
+                # NOTE: set_to_none=True will de-allocate the gradients, saving us some memory.
+                optimizer.zero_grad(set_to_none=True)
 
             state["global_step"] += 1
             state["epoch_step"] += 1
-            state["running_loss"] += outputs.loss.item()
             progress_bar.update(1)
 
+            if compile_start is not None:
+                torch.cuda.synchronize(device)
+                compile_ms = 1000 * (time.time() - compile_start)
+                compile_start = None
+                LOGGER.info(
+                    f"First step (with compilation) took {compile_ms / 1000:.1f}s"
+                )
+                # NOTE: leave it out of the step times, unless it is the only step we'd log.
+                if state["global_step"] % args.log_freq != 0:
+                    for t in timers.values():
+                        t.reset()
+
             if state["global_step"] % args.log_freq == 0:
-                tok_per_step = args.batch_size * args.seq_length
-                ms_per_step = sum(t.avg_elapsed_ms() for t in timers.values())
+                tok_per_step = args.batch_size * args.grad_accum * args.seq_length
+                # NOTE: forward & backward are timed once per micro batch.
+                elapsed_ms = {
+                    k: timer.avg_elapsed_ms()
+                    * (args.grad_accum if k in ["forward", "backward"] else 1)
+                    for k, timer in timers.items()
+                }
+                ms_per_step = sum(elapsed_ms.values())
+                model_tflops = 1e-9 * flops_per_token * tok_per_step / ms_per_step
+                hardware_tflops = (
+                    model_tflops * hardware_flops_per_token / flops_per_token
+                )
+                state["running_loss"] = running_loss.item()
                 info = {
                     "global_step": state["global_step"],
                     "lr": lr_scheduler.get_last_lr()[0],
                     "running_loss": state["running_loss"] / args.log_freq,
                     "epoch": state["epoch"],
-                    "epoch_progress": state["epoch_step"] / len(dataloader),
-                    "num_batches_remaining": len(dataloader) - i_step,
+                    "epoch_progress": state["epoch_step"] / steps_per_epoch,
+                    "num_batches_remaining": len(dataloader) - i_step * args.grad_accum,
                     **get_mem_stats(device),
                     "tok/s": 1000 * tok_per_step / ms_per_step,
+                    "tflops_per_device": model_tflops,
+                    "mfu": model_tflops / args.peak_tflops,
+                    "hfu": hardware_tflops / args.peak_tflops,
                     "time/total": ms_per_step,
-                    **{
-                        f"time/{k}": timer.avg_elapsed_ms()
-                        for k, timer in timers.items()
-                    },
+                    **({"time/compile": compile_ms} if compile_ms is not None else {}),
+                    **{f"time/{k}": ms for k, ms in elapsed_ms.items()},
                 }
 
                 LOGGER.info(info)
@@ -177,16 +305,30 @@ def main():
 
                 torch.cuda.reset_peak_memory_stats(device)
                 state["running_loss"] = 0
+                running_loss.zero_()
                 for t in timers.values():
                     t.reset()
 
             if state["global_step"] % args.ckpt_freq == 0:
+                state["running_loss"] = running_loss.item()
                 LOGGER.info("Saving checkpoint.")
-                torch.save(optimizer.state_dict(), exp_dir / "optimizer.pt")
-                torch.save(model.state_dict(), exp_dir / "model.pt")
-                torch.save(lr_scheduler.state_dict(), exp_dir / "lr_scheduler.pt")
-                with open(exp_dir / "state.json", "w") as fp:
+                # NOTE: we write into a temporary directory first, so a crash part way through
+                #       saving never leaves a torn checkpoint behind.
+                tmp_dir = exp_dir / "checkpoints" / f"step-{state['global_step']}.tmp"
+                tmp_dir.mkdir(parents=True, exist_ok=True)
+                torch.save(optimizer.state_dict(), tmp_dir / "optimizer.pt")
+                torch.save(model.state_dict(), tmp_dir / "model.pt")
+                torch.save(lr_scheduler.state_dict(), tmp_dir / "lr_scheduler.pt")
+                with open(tmp_dir / "state.json", "w") as fp:
                     json.dump(state, fp)
+                if isinstance(train_data, StreamingPackedDataset):
+                    with open(tmp_dir / "data.json", "w") as fp:
+                        json.dump(train_data.state_dict(), fp)
+                _commit_checkpoint(
+                    tmp_dir,
+                    keep_last=args.ckpt_keep_last,
+                    keep_every=args.ckpt_keep_every,
+                )
 
         state["epoch_step"] = 0
 
@@ -196,6 +338,10 @@ def _load_and_preprocess_data(args, config):
     Function created using code found in
     https://github.com/huggingface/transformers/blob/v4.45.1/examples/pytorch/language-modeling/run_clm_no_trainer.py
     """
+    if (Path(args.dataset_name) / "index.json").exists():
+        # NOTE: this is a directory created by pack_dataset.py, which is already tokenized & grouped.
+        return PackedDataset(args.dataset_name, seq_length=args.seq_length)
+
     tokenizer = AutoTokenizer.from_pretrained(args.model_name)
 
     data = datasets.load_dataset(args.dataset_name, trust_remote_code=True)
@@ -247,6 +393,361 @@ def _load_and_preprocess_data(args, config):
     return lm_datasets["train"]
 
 
+class PackedDataset(torch.utils.data.Dataset):
+    """
+    Reads the fixed `seq_length` blocks of token ids written by
+    related-topics/optimizing-data-loading/pack_dataset.py.
+
+    The shards are memory mapped, so nothing is loaded up front, and every sample is a view
+    directly into the page cache (no copies are made until the batch is collated).
+    """
+
+    def __init__(self, path, seq_length=None):
+        self.path = Path(path)
+        with open(self.path / "index.json") as fp:
+            self.index = json.load(fp)
+        if seq_length is not None and seq_length != self.index["seq_length"]:
+            raise ValueError(
+                f"{self.path} was packed with seq_length={self.index['seq_length']}, but seq_length={seq_length} was requested."
+            )
+        self.seq_length = self.index["seq_length"]
+        self.offsets = np.cumsum([0] + [s["num_blocks"] for s in self.index["shards"]])
+        # NOTE: opened lazily so each DataLoader worker process creates its own memory maps.
+        self.shards = None
+        self.position_ids = None
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, i):
+        if self.shards is None:
+            self.shards = [
+                # NOTE: mode="c" is copy-on-write, so the views are writable (which torch wants) but the files are never modified.
+                np.memmap(
+                    self.path / s["path"], dtype=self.index["dtype"], mode="c"
+                ).reshape(-1, self.seq_length)
+                for s in self.index["shards"]
+            ]
+            # NOTE: only written by `--packing best-fit`, where each document has its own positions.
+            self.position_ids = [
+                (
+                    np.memmap(
+                        self.path / s["position_ids_path"],
+                        dtype=self.index["position_ids_dtype"],
+                        mode="c",
+                    ).reshape(-1, self.seq_length)
+                    if "position_ids_path" in s
+                    else None
+                )
+                for s in self.index["shards"]
+            ]
+        shard = int(np.searchsorted(self.offsets, i, side="right")) - 1
+        sample = {
+            "input_ids": torch.from_numpy(self.shards[shard][i - self.offsets[shard]])
+        }
+        if self.position_ids[shard] is not None:
+            sample["position_ids"] = torch.from_numpy(
+                self.position_ids[shard][i - self.offsets[shard]]
+            )
+        return sample
+
+    def __getstate__(self):
+        return {**self.__dict__, "shards": None, "position_ids": None}
+
+
+def packed_data_collator(samples):
+    input_ids = torch.stack([s["input_ids"] for s in samples]).long()
+    # NOTE: labels are just the input_ids (the model shifts them internally), so we don't store them twice.
+    batch = {"input_ids": input_ids, "labels": input_ids}
+    if "position_ids" in samples[0]:
+        # NOTE: every document (and every padding token) starts at position 0. We don't want to
+        #       predict the start of a document from the end of the previous one, or any padding.
+        position_ids = torch.stack([s["position_ids"] for s in samples]).long()
+        batch["position_ids"] = position_ids
+        batch["labels"] = input_ids.masked_fill(position_ids == 0, -100)
+    if "data_state" in samples[-1]:
+        # NOTE: a batch always comes from a single worker, so the last sample has its latest state.
+        batch["data_state"] = samples[-1]["data_state"]
+    return batch
+
+
+def _with_document_mask(batch, *, dtype):
+    """
+    sdpa (unlike flash_attention_2) doesn't notice the position ids restarting, so for packed
+    batches this adds a block diagonal causal mask that keeps every document (and padding token)
+    to itself.
+
+    The mask is built on the device the batch was already copied to, so the DataLoader only ever
+    pins & copies the (batch, seq) position ids. It starts out as bool, but transformers only
+    passes a float (batch, 1, seq, seq) mask straight through to sdpa on a GPU: 0 where a token
+    may attend, and the lowest `dtype` (the compute dtype) everywhere else.
+    """
+    if "position_ids" not in batch:
+        return batch
+    position_ids = batch["position_ids"]
+    doc_ids = (position_ids == 0).cumsum(dim=1)
+    seq_length = position_ids.shape[1]
+    causal = torch.ones(
+        seq_length, seq_length, dtype=torch.bool, device=position_ids.device
+    ).tril()
+    allowed = (doc_ids[:, :, None] == doc_ids[:, None, :]) & causal
+    mask = torch.zeros(allowed.shape, dtype=dtype, device=allowed.device)
+    mask.masked_fill_(~allowed, torch.finfo(dtype).min)
+    return {**batch, "attention_mask": mask[:, None]}
+
+
+class StreamingPackedDataset(torch.utils.data.IterableDataset):
+    """
+    Streams documents (instead of downloading the whole dataset up front), and tokenizes & packs
+    them into `seq_length` blocks on the fly. So the time to the first step doesn't depend on the
+    size of the dataset.
+
+    Every (rank, DataLoader worker) pair reads its own shard of the documents. Blocks are shuffled
+    in windows of `shuffle_buffer` blocks, with a seed derived from the window's position, and the
+    stream starts over (with a different shuffle) once it runs out.
+
+    Each sample carries the state of its worker at the start of its window, plus how far into the
+    window it is. So resuming only has to re-read (at most) one window of documents.
+    """
+
+    def __init__(self, args, *, rank, num_replicas, num_blocks):
+        self.dataset_name = args.dataset_name
+        self.model_name = args.model_name
+        self.seq_length = args.seq_length
+        self.shuffle_buffer = args.shuffle_buffer
+        self.seed = args.seed
+        self.rank = rank
+        self.num_replicas = num_replicas
+        self.num_blocks = num_blocks
+        self.worker_states = {}
+        self.next_worker = 0
+
+    def __len__(self):
+        # NOTE: the stream never runs out, so an "epoch" is however many blocks we were told.
+        return self.num_blocks
+
+    def state_dict(self):
+        return {"worker_states": self.worker_states, "next_worker": self.next_worker}
+
+    def load_state_dict(self, state_dict):
+        self.worker_states = state_dict["worker_states"]
+        self.next_worker = state_dict["next_worker"]
+
+    def update_state(self, data_state):
+        self.worker_states[str(data_state["worker"])] = data_state
+        self.next_worker = data_state["worker"] + 1
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id = 0 if worker_info is None else worker_info.id
+        num_workers = 1 if worker_info is None else worker_info.num_workers
+
+        # NOTE: the DataLoader always gets the first batch from worker 0, so after resuming we
+        #       rotate which part of the stream each worker reads to keep the same order of batches.
+        worker = (worker_id + self.next_worker) % num_workers
+        num_shards = self.num_replicas * num_workers
+        shard = self.rank * num_workers + worker
+
+        state = self.worker_states.get(
+            str(worker),
+            {
+                "worker": worker,
+                "num_shards": num_shards,
+                "pass": 0,
+                "window": 0,
+                "offset": 0,
+                "source": None,
+                "tokens": [],
+            },
+        )
+        if state["num_shards"] != num_shards:
+            raise ValueError(
+                f"Stream was split into {state['num_shards']} shards, but we now have {num_shards} (num_replicas * num_workers)."
+            )
+
+        tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+
+        while True:
+            source = datasets.load_dataset(
+                self.dataset_name, split="train", streaming=True, trust_remote_code=True
+            )
+            source = split_dataset_by_node(source, rank=shard, world_size=num_shards)
+            if state["source"] is not None:
+                source.load_state_dict(state["source"])
+            # NOTE: `.iter()` instead of `iter()`, because iter() notices it is in a DataLoader worker
+            #       and splits the data across workers again (we already did that above).
+            documents = source.iter(batch_size=1)
+
+            while True:
+                state["source"] = copy.deepcopy(source.state_dict())
+                tokens = list(state["tokens"])
+                blocks = []
+                for document in documents:
+                    text = (
+                        document["text"]
+                        if "text" in document
+                        else next(iter(document.values()))
+                    )
+                    tokens.extend(tokenizer(text[0])["input_ids"])
+                    while len(tokens) >= self.seq_length:
+                        blocks.append(tokens[: self.seq_length])
+                        del tokens[: self.seq_length]
+                    if len(blocks) >= self.shuffle_buffer:
+                        break
+                if len(blocks) == 0:
+                    break
+
+                rng = random.Random(
+                    f"{self.seed}-{state['pass']}-{shard}-{state['window']}"
+                )
+                rng.shuffle(blocks)
+                for i in range(state["offset"], len(blocks)):
+                    yield {
+                        "input_ids": torch.tensor(blocks[i]),
+                        "data_state": {**state, "offset": i + 1},
+                    }
+
+                state = {
+                    **state,
+                    "window": state["window"] + 1,
+                    "offset": 0,
+                    "tokens": tokens,
+                }
+
+            # NOTE: leftover tokens that don't fill a block are dropped, like `group_texts` does.
+            state = {
+                **state,
+                "pass": state["pass"] + 1,
+                "window": 0,
+                "source": None,
+                "tokens": [],
+            }
+
+
+class ResumableDistributedSampler(DistributedSampler):
+    """
+    A DistributedSampler that can start part way through an epoch.
+
+    The normal DistributedSampler always starts at the beginning of the epoch, so resuming means
+    loading, collating, and moving to the GPU every batch we already trained on. Instead, we just
+    drop the indices of those batches before the DataLoader ever sees them.
+
+    NOTE: `len()` still reports the full epoch, so `len(dataloader)` keeps meaning batches per epoch.
+    """
+
+    def __init__(self, dataset, *, batch_size, **kwargs):
+        super().__init__(dataset, **kwargs)
+        self.batch_size = batch_size
+        self.start_step = 0
+
+    def set_epoch(self, epoch, start_step=0):
+        super().set_epoch(epoch)
+        self.start_step = start_step
+
+    def __iter__(self):
+        indices = list(super().__iter__())
+        return iter(indices[self.start_step * self.batch_size :])
+
+
+def _checkpoint_step(ckpt_dir):
+    return int(ckpt_dir.name.split("-")[1])
+
+
+def _get_latest_checkpoint(ckpt_root):
+    # NOTE: checkpoints are written to `step-N.tmp` and only renamed to `step-N` once they are
+    #       complete, so every `step-N` directory is a complete checkpoint.
+    ckpt_dirs = [p for p in ckpt_root.glob("step-*") if p.name.split("-")[1].isdigit()]
+    if len(ckpt_dirs) == 0:
+        return None
+    return max(ckpt_dirs, key=_checkpoint_step)
+
+
+def _commit_checkpoint(tmp_dir, *, keep_last, keep_every):
+    """
+    Publishes a fully written `step-N.tmp` directory as `step-N` with an atomic rename, and
+    points `latest` at it. Then deletes (in the background) any checkpoints that fall outside
+    of the retention policy, along with leftovers from saves that crashed part way through.
+    """
+    ckpt_root = tmp_dir.parent
+    ckpt_dir = tmp_dir.with_suffix("")
+    if ckpt_dir.exists():
+        shutil.rmtree(ckpt_dir)
+    tmp_dir.rename(ckpt_dir)
+
+    with open(ckpt_root / "latest.tmp", "w") as fp:
+        fp.write(ckpt_dir.name)
+    os.replace(ckpt_root / "latest.tmp", ckpt_root / "latest")
+    LOGGER.info(f"Committed checkpoint {ckpt_dir}")
+
+    ckpt_dirs = sorted(
+        [p for p in ckpt_root.glob("step-*") if p.name.split("-")[1].isdigit()],
+        key=_checkpoint_step,
+    )
+    expired = [
+        p
+        for p in ckpt_dirs[:-keep_last]
+        if keep_every <= 0 or _checkpoint_step(p) % keep_every != 0
+    ]
+    # NOTE: a `.tmp` from an earlier step is left over from a save that crashed. Later ones are still
+    #       being written (e.g. the data positions of the next checkpoint, while this one committed
+    #       asynchronously), so we leave those alone.
+    stale_tmp_dirs = [
+        p
+        for p in ckpt_root.glob("step-*.tmp")
+        if _checkpoint_step(p.with_suffix("")) < _checkpoint_step(ckpt_dir)
+    ]
+    # NOTE: renaming before deleting means a half deleted checkpoint never looks complete.
+    to_delete = stale_tmp_dirs + list(ckpt_root.glob("step-*.deleting"))
+    for p in expired:
+        to_delete.append(p.rename(p.with_name(p.name + ".deleting")))
+    threading.Thread(
+        target=lambda: [shutil.rmtree(p, ignore_errors=True) for p in to_delete],
+        daemon=True,
+    ).start()
+
+
+def _compile_decoder_layers(model, *, cache_dir=None):
+    """
+    torch.compiles the forward of each LlamaDecoderLayer on its own. All of the layers run the
+    same code, so they share the compiled graphs. Compiling is lazy, it happens during the first
+    forward & backward.
+    """
+    if cache_dir is not None:
+        # NOTE: inductor (and triton) cache the compiled kernels here. On node-local disk, a
+        #       restarted run reuses them instead of compiling everything again.
+        os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_dir
+    for module in model.modules():
+        if isinstance(module, LlamaDecoderLayer):
+            # NOTE: compiling `forward` (instead of the module) keeps hooks on the layer itself,
+            #       like FSDP's all-gathers, out of the compiled graph. It also leaves the
+            #       parameter names (and so the checkpoints) unchanged.
+            module.forward = torch.compile(module.forward)
+
+
+def get_flops_per_token(config, seq_length):
+    """
+    FLOPs of the forward pass of a llama model, per token. Only counts the matmuls (2 FLOPs per
+    multiply-add), since everything else is tiny in comparison. Returns the FLOPs of the
+    attention & mlp of a single decoder layer, and of the whole model.
+    """
+    head_dim = getattr(config, "head_dim", None) or (
+        config.hidden_size // config.num_attention_heads
+    )
+    q_and_o = 2 * config.hidden_size * config.num_attention_heads * head_dim
+    k_and_v = 2 * config.hidden_size * config.num_key_value_heads * head_dim
+    # NOTE: every token's query is multiplied with seq_length keys, and the scores with seq_length
+    #       values. We count all of them like PaLM's MFU does, even though a causal mask skips half.
+    scores = 2 * seq_length * config.num_attention_heads * head_dim
+    attn = 2 * (q_and_o + k_and_v + scores)
+    mlp = 2 * 3 * config.hidden_size * config.intermediate_size
+    lm_head = 2 * config.hidden_size * config.vocab_size
+    return {
+        "attn": attn,
+        "mlp": mlp,
+        "total": config.num_hidden_layers * (attn + mlp) + lm_head,
+    }
+
+
 def get_mem_stats(device=None):
     mem = torch.cuda.memory_stats(device)
     props = torch.cuda.get_device_properties(device)
@@ -259,33 +760,157 @@ def get_mem_stats(device=None):
     }
 
 
+class DevicePrefetcher:
+    """
+    Wraps an iterator of batches, and keeps the next `num_batches` of them in flight to `device`,
+    so the training loop gets batches that are already there.
+
+    On a GPU, the (pinned) batches are copied on a separate stream with `non_blocking=True`, which
+    overlaps the copies with the compute of the current step. On a CPU there is nothing to copy, so
+    a background thread just loads the next batches ahead of time instead.
+    """
+
+    def __init__(self, batches, device, num_batches=2):
+        self.batches = iter(batches)
+        self.device = device
+        if device.type == "cuda":
+            self.stream = torch.cuda.Stream(device=device)
+            self.ready = collections.deque()
+            for _ in range(num_batches):
+                self._copy_next()
+        else:
+            self.ready = queue.Queue(maxsize=num_batches)
+            # NOTE: the thread doesn't hold a reference to us, so once the training loop drops us we
+            #       can tell it to stop (and let go of the DataLoader workers).
+            self.stop = threading.Event()
+            threading.Thread(
+                target=self._load_in_background,
+                args=(self.batches, device, self.ready, self.stop),
+                daemon=True,
+            ).start()
+
+    def __del__(self):
+        if self.device.type != "cuda":
+            self.stop.set()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.device.type != "cuda":
+            batch = self.ready.get()
+            if isinstance(batch, BaseException):
+                raise batch
+            return batch
+
+        if len(self.ready) == 0:
+            raise StopIteration
+        batch, copied = self.ready.popleft()
+        stream = torch.cuda.current_stream(self.device)
+        stream.wait_event(copied)
+        for v in batch.values():
+            if isinstance(v, torch.Tensor):
+                # NOTE: this memory was allocated on our side stream, so we tell the caching allocator
+                #       not to reuse it until the compute stream is done with it too.
+                v.record_stream(stream)
+        self._copy_next()
+        return batch
+
+    def _copy_next(self):
+        try:
+            batch = next(self.batches)
+        except StopIteration:
+            return
+        with torch.cuda.stream(self.stream):
+            batch = {
+                k: (
+                    v.to(self.device, non_blocking=True)
+                    if isinstance(v, torch.Tensor)
+                    else v
+                )
+                for k, v in batch.items()
+            }
+            copied = torch.cuda.Event()
+            copied.record(self.stream)
+        self.ready.append((batch, copied))
+
+    @staticmethod
+    def _load_in_background(batches, device, ready, stop):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    ready.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for batch in batches:
+                batch = {
+                    k: v.to(device) if isinstance(v, torch.Tensor) else v
+                    for k, v in batch.items()
+                }
+                if not put(batch):
+                    return
+            put(StopIteration())
+        except Exception as err:
+            put(err)
+
+
 class LocalTimer:
-    def __init__(self, device: torch.device):
+    """
+    By default this just records a pair of CUDA events around each block, and only waits for them
+    when `avg_elapsed_ms()` is called (i.e. every `--log-freq` steps), so the CPU can keep queueing
+    up work for the GPU. With `sync=True` it synchronizes the device before & after each block
+    instead, which makes each measurement exact but stalls the GPU - only useful for debugging.
+    """
+
+    def __init__(self, device: torch.device, sync: bool = False):
         if device.type == "cpu":
             self.synchronize = lambda: torch.cpu.synchronize(device=device)
         elif device.type == "cuda":
             self.synchronize = lambda: torch.cuda.synchronize(device=device)
+        # NOTE: there is nothing asynchronous to wait for on CPU, so we just read the clock.
+        self.use_events = device.type == "cuda" and not sync
+        self.sync = sync
         self.measurements = []
-        self.start_time = None
+        self.pending_events = []
+        self.start = None
 
     def __enter__(self):
-        self.synchronize()
-        self.start_time = time.time()
+        if self.use_events:
+            self.start = torch.cuda.Event(enable_timing=True)
+            self.start.record()
+        else:
+            if self.sync:
+                self.synchronize()
+            self.start = time.time()
         return self
 
     def __exit__(self, type, value, traceback):
         if traceback is None:
-            self.synchronize()
-            end_time = time.time()
-            self.measurements.append(end_time - self.start_time)
-        self.start_time = None
+            if self.use_events:
+                end = torch.cuda.Event(enable_timing=True)
+                end.record()
+                self.pending_events.append((self.start, end))
+            else:
+                if self.sync:
+                    self.synchronize()
+                self.measurements.append(1000 * (time.time() - self.start))
+        self.start = None
 
     def avg_elapsed_ms(self):
-        return 1000 * (sum(self.measurements) / len(self.measurements))
+        if len(self.pending_events) > 0:
+            self.pending_events[-1][1].synchronize()
+            self.measurements.extend(s.elapsed_time(e) for s, e in self.pending_events)
+            self.pending_events = []
+        return sum(self.measurements) / len(self.measurements)
 
     def reset(self):
         self.measurements = []
-        self.start_time = None
+        self.pending_events = []
+        self.start = None
 
 
 def _get_parser() -> argparse.ArgumentParser:
@@ -297,10 +922,93 @@ def _get_parser() -> argparse.ArgumentParser:
     parser.add_argument("--seed", default=0, type=int)
     parser.add_argument("--num-epochs", default=100, type=int)
     parser.add_argument("--lr", default=3e-5, type=float)
+    parser.add_argument(
+        "--master-dtype",
+        default="bf16",
+        choices=["bf16", "fp32"],
+        help="dtype of the weights the optimizer updates.",
+    )
+    parser.add_argument(
+        "--param-dtype",
+        default=None,
+        choices=["bf16", "fp32"],
+        help="dtype that forward & backward run in. Defaults to --master-dtype.",
+    )
+    parser.add_argument(
+        "--buffer-dtype",
+        default=None,
+        choices=["bf16", "fp32"],
+        help="dtype for floating point buffers (like the rotary embedding's inv_freq). Defaults to leaving them as the model creates them.",
+    )
     parser.add_argument("-b", "--batch-size", default=1, type=int)
+    parser.add_argument(
+        "--grad-accum",
+        default=1,
+        type=int,
+        help="Number of batches to accumulate gradients over for each optimizer step.",
+    )
     parser.add_argument("--log-freq", default=100, type=int)
+    parser.add_argument(
+        "--device-prefetch",
+        default=2,
+        type=int,
+        help="Number of batches copied to the device ahead of time.",
+    )
+    parser.add_argument(
+        "--timer-mode",
+        default="events",
+        choices=["events", "sync"],
+        help="sync waits for the GPU around every timed block, which is exact but slow.",
+    )
     parser.add_argument("--ckpt-freq", default=500, type=int)
+    parser.add_argument(
+        "--ckpt-keep-last",
+        default=1,
+        type=int,
+        help="Number of most recent checkpoints to keep (at least 1).",
+    )
+    parser.add_argument(
+        "--ckpt-keep-every",
+        default=0,
+        type=int,
+        help="Also keep every checkpoint whose step is a multiple of this (0 to disable).",
+    )
     parser.add_argument("-s", "--seq-length", default=1024, type=int)
+    parser.add_argument(
+        "--streaming",
+        default="off",
+        choices=["on", "off"],
+        help="Tokenize & pack the dataset on the fly, instead of preprocessing all of it before training.",
+    )
+    parser.add_argument(
+        "--shuffle-buffer",
+        default=1000,
+        type=int,
+        help="Number of blocks shuffled together when streaming.",
+    )
+    parser.add_argument(
+        "--steps-per-epoch",
+        default=1000,
+        type=int,
+        help="Only used when streaming, since a stream has no length.",
+    )
+    parser.add_argument(
+        "--compile",
+        default="off",
+        choices=["on", "off"],
+        help="torch.compile each decoder layer.",
+    )
+    parser.add_argument(
+        "--compile-cache-dir",
+        default=None,
+        help="Where torch.compile caches compiled kernels, ideally on node-local disk. Defaults to torch's own temporary directory.",
+    )
+    parser.add_argument(
+        "--peak-tflops",
+        default=989.0,
+        type=float,
+        help="Peak TFLOPs of a single GPU, for MFU & HFU. The default is a H100 SXM's dense bf16 peak.",
+    )
     return parser
 
 
@@ -0,0 +1,153 @@
+import argparse
+import ast
+import itertools
+import json
+import logging
+import os
+import re
+import signal
+import subprocess
+import tempfile
+
+LOGGER = logging.getLogger(__name__)
+
+# NOTE: what train_llm.py logs on rank 0 every --log-freq steps.
+INFO_PATTERN = re.compile(r"\[rank=0\].*INFO:(\{'global_step'.*\})$")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Runs a short benchmark of train_llm.py for every combination of FSDP settings, and reports tok/s & peak memory for each.",
+        usage="python sweep.py [options] -- <command that launches train_llm.py>",
+    )
+    parser.add_argument(
+        "--sharding-strategy",
+        nargs="+",
+        default=["full-shard", "shard-grad-op", "hybrid-shard"],
+    )
+    parser.add_argument("--backward-prefetch", nargs="+", default=["pre", "post"])
+    parser.add_argument("--forward-prefetch", nargs="+", default=["off", "on"])
+    parser.add_argument("--limit-all-gathers", nargs="+", default=["on"])
+    parser.add_argument(
+        "--num-logs",
+        default=3,
+        type=int,
+        help="Stop each run after this many log lines. The first one is skipped, since it includes warmup.",
+    )
+    parser.add_argument("--log-freq", default=10, type=int)
+    parser.add_argument(
+        "--output", default=None, help="Also write the results as json lines here."
+    )
+    parser.add_argument("command", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format=f"[%(asctime)s] %(levelname)s:%(message)s",
+        level=logging.INFO,
+    )
+
+    command = args.command[1:] if args.command[:1] == ["--"] else args.command
+    if len(command) == 0:
+        parser.error("missing the command that launches train_llm.py")
+
+    names = [
+        "sharding_strategy",
+        "backward_prefetch",
+        "forward_prefetch",
+        "limit_all_gathers",
+    ]
+    results = []
+    with tempfile.TemporaryDirectory() as save_dir:
+        for values in itertools.product(*(getattr(args, n) for n in names)):
+            settings = dict(zip(names, values))
+            name = "sweep-" + "-".join(values)
+            run_command = command + [
+                "--experiment-name",
+                name,
+                # NOTE: a fresh directory, so we never resume, and a checkpoint is never saved.
+                "--save-dir",
+                save_dir,
+                "--ckpt-freq",
+                str(10**9),
+                "--log-freq",
+                str(args.log_freq),
+            ]
+            for n, v in settings.items():
+                run_command += ["--" + n.replace("_", "-"), v]
+            LOGGER.info(f"Running {name}")
+            info = _run(run_command, args.num_logs)
+            results.append({**settings, **info})
+            LOGGER.info(results[-1])
+            if args.output is not None:
+                with open(args.output, "a") as fp:
+                    fp.write(json.dumps(results[-1]) + "\n")
+
+    results.sort(key=lambda r: -r.get("tok/s", 0))
+    header = " | ".join(f"{n:>20}" for n in names)
+    print(f"{header} | {'tok/s':>10} | {'peak_alloc_gb':>13} | {'peak_resv_gb':>12}")
+    for r in results:
+        row = " | ".join(f"{r[n]:>20}" for n in names)
+        if "tok/s" in r:
+            print(
+                f"{row} | {r['tok/s']:>10.1f} | {r['peak_alloc_gb']:>13.1f} | {r['peak_resv_gb']:>12.1f}"
+            )
+        else:
+            print(f"{row} | {r['error']:>10}")
+
+
+def _run(command, num_logs):
+    """
+    Runs `command` until rank 0 has logged `num_logs` times (or it exits), and returns the
+    average tok/s & the highest peak memory over all but the first log.
+    """
+    # NOTE: wandb would create a run for every combination.
+    env = {"WANDB_MODE": "disabled", **os.environ}
+    proc = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        env=env,
+        # NOTE: its own process group, so we can stop torchrun & all of its workers at once.
+        start_new_session=True,
+    )
+    infos = []
+    tail = []
+    try:
+        for line in proc.stdout:
+            tail = (tail + [line.rstrip()])[-20:]
+            match = INFO_PATTERN.search(line.rstrip())
+            if match is None:
+                continue
+            try:
+                infos.append(ast.literal_eval(match.group(1)))
+            except (ValueError, SyntaxError):
+                # NOTE: all ranks share stdout, so another rank's output can end up in the middle of this line.
+                LOGGER.warning(f"Skipping garbled line: {line.rstrip()}")
+                continue
+            if len(infos) >= num_logs:
+                break
+    finally:
+        if proc.poll() is None:
+            os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait()
+
+    infos = infos[1:]
+    if len(infos) == 0:
+        LOGGER.error("\n".join(tail))
+        # NOTE: usually an OOM for the bigger settings.
+        return {"error": f"exit={proc.returncode}"}
+    # NOTE: chapter 5 calls these peak_alloc_in_gb & peak_resv_in_gb.
+    return {
+        "tok/s": sum(i["tok/s"] for i in infos) / len(infos),
+        "peak_alloc_gb": max(
+            i.get("peak_alloc_gb", i.get("peak_alloc_in_gb")) for i in infos
+        ),
+        "peak_resv_gb": max(
+            i.get("peak_resv_gb", i.get("peak_resv_in_gb")) for i in infos
+        ),
+    }
+
+
+if __name__ == "__main__":
+    main()
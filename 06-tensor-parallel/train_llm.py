@@ -1,31 +1,55 @@
 import argparse
-from contextlib import contextmanager
-from itertools import chain
+import bisect
+import collections
+from contextlib import contextmanager, nullcontext
+import copy
+import functools
+import hashlib
 import json
-import multiprocessing
 import os
+import queue
+import random
+import re
+import shutil
+import socket
+import threading
 import time
 from pathlib import Path
 import logging
 
+import numpy as np
+import pyarrow.compute as pc
 import torch
 from torch.utils.data import DataLoader
 from torch.utils.data.distributed import DistributedSampler
 from torch import distributed as dist
 import torch.distributed.tensor.parallel as tp
-from torch.distributed._tensor import Shard, Replicate
+from torch.distributed._tensor import DTensor, Shard, Replicate
+from torch.distributed.tensor._utils import compute_local_shape_and_global_offset
+from torch.distributed.tensor.experimental import context_parallel
 from torch.distributed.elastic.multiprocessing.errors import record
 import torch.distributed.checkpoint as DCP
+from torch.distributed.checkpoint import async_save
+from torch.distributed.checkpoint.state_dict import (
+    get_state_dict,
+    set_state_dict,
+    StateDictOptions,
+)
 
 
 import wandb
 import tqdm
 import datasets
+from datasets.distributed import split_dataset_by_node
 from transformers import (
     AutoConfig,
     AutoModelForCausalLM,
     AutoTokenizer,
-    default_data_collator,
+)
+from transformers.models.llama.modeling_llama import (
+    LlamaDecoderLayer,
+    LlamaRMSNorm,
+    LlamaRotaryEmbedding,
 )
 
 LOGGER = logging.getLogger(__name__)
@@ -35,8 +59,13 @@ LOGGER = logging.getLogger(__name__)
 def main():
     parser = _get_parser()
     args = parser.parse_args()
+    if args.ckpt_keep_last < 1:
+        parser.error("--ckpt-keep-last has to keep at least the newest checkpoint.")
 
-    dist.init_process_group()
+    # NOTE: async checkpointing needs a CPU backend, since it coordinates ranks from a background thread.
+    dist.init_process_group(
+        backend="cpu:gloo,cuda:nccl" if args.async_ckpt == "on" else None
+    )
 
     gpus_on_node = torch.cuda.device_count()
 
@@ -48,11 +77,14 @@ def main():
         world_size % gpus_on_node == 0
     ), "This script assumes all nodes have the same amount of GPUs"
     num_nodes = world_size // gpus_on_node
+    assert gpus_on_node % args.cp == 0, "--cp must divide the number of GPUs on a node"
 
+    # NOTE: each node is split into `cp` groups of tp ranks. All of them work on the same batch,
+    #       and each cp rank on its own piece of the sequence.
     mesh = dist.device_mesh.init_device_mesh(
         "cuda",
-        (num_nodes, gpus_on_node),
-        mesh_dim_names=("dp", "tp"),
+        (num_nodes, args.cp, gpus_on_node // args.cp),
+        mesh_dim_names=("dp", "cp", "tp"),
     )
 
     logging.basicConfig(
@@ -63,10 +95,25 @@ def main():
     LOGGER.info(os.environ)
     LOGGER.info(args)
     LOGGER.info(f"local_rank={local_rank} rank={rank} world size={world_size}")
-    LOGGER.info(f"dp_size={mesh['dp'].size()} tp_size={mesh['tp'].size()}")
+    LOGGER.info(
+        f"dp_size={mesh['dp'].size()} cp_size={mesh['cp'].size()} tp_size={mesh['tp'].size()}"
+    )
+    if args.cp > 1:
+        assert (
+            args.seq_length % (args.cp * mesh["tp"].size()) == 0
+        ), "--seq-length must be divisible by cp * tp"
+        if args.compile == "on":
+            raise ValueError("--compile doesn't support --cp yet.")
 
     device = torch.device(f"cuda:{local_rank}")
-    dtype = torch.bfloat16
+    dtypes = {"bf16": torch.bfloat16, "fp32": torch.float32}
+    # NOTE: the model (and so the optimizer) keeps its weights in `dtype`, and autocast runs
+    #       forward & backward in `param_dtype`.
+    dtype = dtypes[args.master_dtype]
+    param_dtype = dtypes[args.param_dtype or args.master_dtype]
+    if param_dtype.itemsize > dtype.itemsize:
+        raise ValueError("autocast can't run in higher precision than --master-dtype.")
+    LOGGER.info(f"master={dtype} param={param_dtype}")
     torch.cuda.set_device(device)
 
     torch.manual_seed(args.seed)
@@ -75,9 +122,13 @@ def main():
 
     with rank_ordered(should_go_first=local_rank == 0):
         config = AutoConfig.from_pretrained(args.model_name, use_cache=False)
-        with device:
+        # NOTE: meta device will not allocate any memory, each rank only materializes its own shards below.
+        with torch.device("meta"):
             model = AutoModelForCausalLM.from_config(
-                config, torch_dtype=dtype, attn_implementation="flash_attention_2"
+                config,
+                torch_dtype=dtype,
+                # NOTE: context parallel works by replacing torch's scaled_dot_product_attention.
+                attn_implementation="sdpa" if args.cp > 1 else "flash_attention_2",
             )
     LOGGER.info(f"{sum(p.numel() for p in model.parameters())} model parameters")
 
@@ -131,33 +182,57 @@ def main():
     LOGGER.info(f"{sum(p.numel() for p in model.parameters())} model parameters")
 
     model = model.to_empty(device=device)
-    model.init_weights()
+    _init_weights(model, seed=args.seed)
     model.train()
 
+    if args.buffer_dtype is not None:
+        for buffer in model.buffers():
+            if buffer.is_floating_point():
+                buffer.data = buffer.data.to(dtypes[args.buffer_dtype])
+
     LOGGER.info(f"{get_mem_stats(device)}")
 
-    # NOTE: since this can download data, make sure to do the main process first on each node
-    # since we manually specified HF_HOME to be a node local drive.
-    with rank_ordered(should_go_first=local_rank == 0):
-        train_data = _load_and_preprocess_data(args, config)
+    if args.compile == "on":
+        _compile_decoder_layers(model, cache_dir=args.compile_cache_dir)
+
+    if args.streaming == "on":
+        # NOTE: streaming reads its own part of the data on the fly, so there is nothing to download first.
+        train_data = StreamingPackedDataset(
+            args,
+            rank=mesh["dp"].get_local_rank(),
+            num_replicas=mesh["dp"].size(),
+            num_blocks=args.steps_per_epoch * args.batch_size * args.grad_accum,
+        )
+    else:
+        # NOTE: only the first process on each node preprocesses the data (since we manually
+        #       specified HF_HOME to be a node local drive), everyone else waits for it to finish.
+        train_data = _load_and_preprocess_data(args, config, is_builder=local_rank == 0)
     LOGGER.info(f"{len(train_data)} training samples")
 
     dataloader = DataLoader(
         train_data,
         batch_size=args.batch_size,
-        collate_fn=default_data_collator,
+        collate_fn=packed_data_collator,
+        pin_memory=True,
         num_workers=1,
         prefetch_factor=2,
         # NOTE: this sampler will split dataset evenly across workers
-        sampler=DistributedSampler(
-            train_data,
-            shuffle=True,
-            drop_last=True,
-            num_replicas=mesh["dp"].size(),  # equivalent to `num_nodes`
-            rank=mesh["dp"].get_local_rank(),  # equivalent to `rank // num_nodes`
+        sampler=(
+            None
+            if isinstance(train_data, StreamingPackedDataset)
+            else ResumableDistributedSampler(
+                train_data,
+                batch_size=args.batch_size,
+                shuffle=True,
+                drop_last=True,
+                num_replicas=mesh["dp"].size(),  # equivalent to `num_nodes`
+                rank=mesh["dp"].get_local_rank(),  # equivalent to `rank // num_nodes`
+            )
         ),
     )
     LOGGER.info(f"{len(dataloader)} batches per epoch")
+    # NOTE: a step is one optimizer update, which takes `--grad-accum` batches.
+    steps_per_epoch = len(dataloader) // args.grad_accum
 
     optimizer = torch.optim.AdamW(model.parameters(), lr=args.lr, fused=True)
     lr_scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(
@@ -166,33 +241,67 @@ def main():
 
     exp_dir: Path = Path(args.save_dir) / args.experiment_name
 
+    # NOTE: full_state_dict=False means every rank only saves/loads its own shards. These are keyed
+    #       by parameter name and record their global layout, which is what lets us resume on a
+    #       different mesh.
+    ckpt_opts = StateDictOptions(full_state_dict=False)
+
+    global_batch_size = mesh["dp"].size() * args.batch_size * args.grad_accum
+
     # attempt resume
     state = {
         "epoch": 0,
         "global_step": 0,
         "epoch_step": 0,
         "running_loss": 0,
+        "global_batch_size": global_batch_size,
     }
     resumed = False
-    if (exp_dir / "state.json").exists():
+    ckpt_dir = _get_latest_checkpoint(exp_dir / "checkpoints")
+    if ckpt_dir is not None:
+        LOGGER.info(f"Resuming from {ckpt_dir}")
+        # NOTE: these are laid out for the *current* mesh, and DCP only reads the parts of the
+        #       checkpoint that overlap with each rank's shards. No rank ever holds the full model.
+        sharded_model_state, sharded_optimizer_state = get_state_dict(
+            model, optimizer, options=ckpt_opts
+        )
         DCP.load(
-            dict(model=model, optimizer=optimizer),
-            checkpoint_id=exp_dir / "checkpoint",
+            dict(model=sharded_model_state, optimizer=sharded_optimizer_state),
+            checkpoint_id=ckpt_dir,
+        )
+        set_state_dict(
+            model,
+            optimizer,
+            model_state_dict=sharded_model_state,
+            optim_state_dict=sharded_optimizer_state,
+            options=ckpt_opts,
         )
         lr_scheduler.load_state_dict(
             torch.load(
-                exp_dir / "lr_scheduler.pt", map_location=device, weights_only=True
+                ckpt_dir / "lr_scheduler.pt", map_location=device, weights_only=True
             )
         )
-        with open(exp_dir / "state.json") as fp:
+        with open(ckpt_dir / "state.json") as fp:
             state = json.load(fp)
+        if isinstance(train_data, StreamingPackedDataset):
+            with open(ckpt_dir / f"data-rank-{rank}.json") as fp:
+                train_data.load_state_dict(json.load(fp))
+        # NOTE: the world size (or mesh shape / batch size) may have changed since this checkpoint
+        #       was saved. The sampler skips `epoch_step` steps of the *current* global batch size,
+        #       so we convert it to keep skipping the same number of samples.
+        if state["global_batch_size"] != global_batch_size:
+            state["epoch_step"] = (
+                state["epoch_step"] * state["global_batch_size"] // global_batch_size
+            )
+            state["global_batch_size"] = global_batch_size
         resumed = True
     LOGGER.info(f"Resumed={resumed} | {state}")
     dist.barrier()
 
-    if (exp_dir.is_mount() and rank == 0) or (
-        not exp_dir.is_mount() and local_rank == 0
-    ):
+    # NOTE: whoever creates the experiment directory also commits the checkpoints written into it.
+    #       On shared storage every node sees the same `step-N.tmp`, so only one rank may rename it.
+    is_ckpt_owner = rank == 0 if args.ckpt_storage == "shared" else local_rank == 0
+    if is_ckpt_owner:
         LOGGER.info(f"Creating experiment root directory")
         exp_dir.mkdir(parents=True, exist_ok=True)
     dist.barrier()
@@ -213,62 +322,243 @@ def main():
             },
         )
 
-    timers = {k: LocalTimer(device) for k in ["data", "forward", "backward", "update"]}
+    # NOTE: the backward pass does twice the matmuls of the forward pass (the gradients of both
+    #       the inputs & the weights).
+    flops_per_token = 3 * get_flops_per_token(config, args.seq_length)["total"]
+    hardware_flops_per_token = flops_per_token
+
+    # NOTE: so we can say where a slow rank is running.
+    rank_hosts = [None] * world_size
+    dist.all_gather_object(rank_hosts, (socket.gethostname(), local_rank))
+    num_slow_logs = [0] * world_size
+
+    timers = {
+        k: LocalTimer(device, sync=args.timer_mode == "sync")
+        for k in ["data", "forward", "backward", "update"]
+    }
+    # NOTE: calling .item() on the loss every step would make the CPU wait for the GPU, so we
+    #       accumulate on the GPU and only copy it back when logging/checkpointing.
+    #       With --cp the saved value is the sum over the cp ranks (see _sum_over_cp), so only one
+    #       of them starts from it.
+    running_loss = torch.tensor(
+        state["running_loss"] if mesh["cp"].get_local_rank() == 0 else 0,
+        dtype=torch.float32,
+        device=device,
+    )
+    checkpointer = AsyncCheckpointer()
+
+    # NOTE: with --compile on, the first step also compiles the model. We time it on its own.
+    compile_ms = None
+    compile_start = None
+    # NOTE: with --profile on, the selected ranks record the steps in
+    #       [profile_start, profile_start + profile_steps), and the summary goes into the next log.
+    profiler = None
+    profile_info = {}
 
     for state["epoch"] in range(state["epoch"], args.num_epochs):
         LOGGER.info(f"Begin epoch {state['epoch']} at step {state['epoch_step']}")
 
-        progress_bar = tqdm.tqdm(range(len(dataloader)), disable=True)
+        progress_bar = tqdm.tqdm(range(steps_per_epoch), disable=True)
         if state["epoch_step"] > 0:
             progress_bar.update(state["epoch_step"])
 
-        batches = iter(dataloader)
-
-        for i_step in range(len(dataloader)):
-            with timers["data"], torch.no_grad():
-                batch = next(batches)
-                batch = {k: v.to(device=device) for k, v in batch.items()}
-                batch["position_ids"] = torch.arange(
-                    0, args.seq_length, device=device, dtype=torch.long
-                ).unsqueeze(0)
-
-            if i_step < state["epoch_step"]:
-                # NOTE: for resuming
-                continue
+        # NOTE: start_step makes the sampler skip the batches we already trained on when resuming,
+        #       so we never load them. state["epoch"] & state["epoch_step"] are the sampler's position.
+        #       A streaming dataset keeps track of its own position instead.
+        if not isinstance(train_data, StreamingPackedDataset):
+            dataloader.sampler.set_epoch(
+                state["epoch"], start_step=state["epoch_step"] * args.grad_accum
+            )
+        # NOTE: copies the next batches to the GPU while we are still computing the current one.
+        batches = DevicePrefetcher(dataloader, device, num_batches=args.device_prefetch)
+
+        for i_step in range(state["epoch_step"], steps_per_epoch):
+            if (
+                args.profile == "on"
+                and rank in args.profile_ranks
+                and state["global_step"] == args.profile_start
+            ):
+                profiler = torch.profiler.profile(
+                    activities=[
+                        torch.profiler.ProfilerActivity.CPU,
+                        torch.profiler.ProfilerActivity.CUDA,
+                    ]
+                )
+                profiler.start()
 
-            with tp.loss_parallel(), timers["forward"]:
-                outputs = model(**batch)
+            if args.compile == "on" and compile_ms is None:
+                torch.cuda.synchronize(device)
+                compile_start = time.time()
 
-            with tp.loss_parallel(), timers["backward"]:
-                outputs.loss.backward()
+            with timers["data"], torch.no_grad():
+                micro_batches = [next(batches) for _ in range(args.grad_accum)]
+                for batch in micro_batches:
+                    if "data_state" in batch:
+                        train_data.update_state(batch.pop("data_state"))
+                    if "position_ids" not in batch:
+                        batch["position_ids"] = torch.arange(
+                            0, args.seq_length, device=device, dtype=torch.long
+                        ).unsqueeze(0)
+                # NOTE: the loss is averaged over the tokens the model predicts, and micro batches
+                #       can have different numbers of those, so we weight each one by its share.
+                num_targets = [
+                    (b["labels"][:, 1:] != -100).sum() for b in micro_batches
+                ]
+                total_targets = sum(num_targets)
+
+            for i_micro, batch in enumerate(micro_batches):
+                cp_context = nullcontext()
+                if args.cp > 1:
+                    # NOTE: the model shifts the labels by one internally, which doesn't work when each
+                    #       rank only has a piece of the sequence. So we shift them before sharding,
+                    #       and compute the loss ourselves.
+                    batch = {
+                        "input_ids": batch["input_ids"],
+                        "labels": torch.nn.functional.pad(
+                            batch["labels"][:, 1:], (0, 1), value=-100
+                        ),
+                        "position_ids": batch["position_ids"]
+                        .expand_as(batch["input_ids"])
+                        .contiguous(),
+                    }
+                    # NOTE: shards the tensors along the sequence dimension (in place), and replaces
+                    #       scaled_dot_product_attention with ring attention over the cp ranks, for
+                    #       both forward & backward. position_ids are sharded the same way, so the
+                    #       rotary embeddings still see each token's real position.
+                    cp_context = context_parallel(
+                        mesh["cp"],
+                        buffers=list(batch.values()),
+                        buffer_seq_dims=[1, 1, 1],
+                        no_restore_buffers=set(batch.values()),
+                    )
+
+                with cp_context:
+                    with tp.loss_parallel(), timers["forward"], torch.autocast(
+                        device.type, dtype=param_dtype, enabled=param_dtype != dtype
+                    ):
+                        if args.cp > 1:
+                            logits = model(
+                                input_ids=batch["input_ids"],
+                                position_ids=batch["position_ids"],
+                            ).logits
+                            # NOTE: the sum over this rank's tokens. Summing it over the cp ranks
+                            #       gives the loss of the whole sequence.
+                            loss_sum = torch.nn.functional.cross_entropy(
+                                logits.flatten(0, 1).float(),
+                                batch["labels"].flatten(),
+                                ignore_index=-100,
+                                reduction="sum",
+                            )
+                        else:
+                            outputs = model(**batch)
+
+                    with tp.loss_parallel(), timers["backward"]:
+                        if args.cp > 1:
+                            loss = loss_sum / total_targets
+                        else:
+                            loss = outputs.loss * num_targets[i_micro] / total_targets
+                        loss.backward()
+
+                running_loss += loss.detach()
 
             with timers["update"]:
+                if args.cp > 1:
+                    # NOTE: every cp rank has the same (tp sharded) weights, but only the gradients
+                    #       from its own piece of the sequence.
+                    _all_reduce_grads(model, mesh["cp"].get_group())
                 optimizer.step()
                 lr_scheduler.step()
                 optimizer.zero_grad(set_to_none=True)
 
             state["global_step"] += 1
             state["epoch_step"] += 1
-            state["running_loss"] += outputs.loss.item()
             progress_bar.update(1)
 
+            if profiler is not None:
+                profiler.step()
+                if state["global_step"] == args.profile_start + args.profile_steps:
+                    profiler.stop()
+                    trace_path = (
+                        exp_dir
+                        / "traces"
+                        / f"rank-{rank}-step-{args.profile_start}-{state['global_step']}.json"
+                    )
+                    trace_path.parent.mkdir(parents=True, exist_ok=True)
+                    profiler.export_chrome_trace(str(trace_path))
+                    profiler = None
+                    profile_info = summarize_trace(
+                        trace_path, num_steps=args.profile_steps
+                    )
+                    LOGGER.info(f"Saved profiler trace to {trace_path}")
+
+            if compile_start is not None:
+                torch.cuda.synchronize(device)
+                compile_ms = 1000 * (time.time() - compile_start)
+                compile_start = None
+                LOGGER.info(
+                    f"First step (with compilation) took {compile_ms / 1000:.1f}s"
+                )
+                # NOTE: leave it out of the step times, unless it is the only step we'd log.
+                if state["global_step"] % args.log_freq != 0:
+                    for t in timers.values():
+                        t.reset()
+
             if state["global_step"] % args.log_freq == 0:
-                tok_per_step = mesh["dp"].size() * args.batch_size * args.seq_length
-                ms_per_step = sum(t.avg_elapsed_ms() for t in timers.values())
+                tok_per_step = (
+                    mesh["dp"].size()
+                    * args.batch_size
+                    * args.grad_accum
+                    * args.seq_length
+                )
+                # NOTE: forward & backward are timed once per micro batch.
+                elapsed_ms = {
+                    k: timer.avg_elapsed_ms()
+                    * (args.grad_accum if k in ["forward", "backward"] else 1)
+                    for k, timer in timers.items()
+                }
+                ms_per_step = sum(elapsed_ms.values())
+                model_tflops = (
+                    1e-9 * flops_per_token * tok_per_step / ms_per_step / world_size
+                )
+                hardware_tflops = (
+                    model_tflops * hardware_flops_per_token / flops_per_token
+                )
+                # NOTE: rank 0's own timers can't show a single slow rank, so we gather everyone's.
+                #       It's one small all-gather per log.
+                rank_ms = gather_rank_timings(elapsed_ms, device)
+                slow_ranks = find_slow_ranks(
+                    rank_ms, list(elapsed_ms), threshold=args.straggler_threshold
+                )
+                for r in range(world_size):
+                    num_slow_logs[r] = num_slow_logs[r] + 1 if r in slow_ranks else 0
+                    # NOTE: warns again every --straggler-patience logs, for as long as it stays slow.
+                    if (
+                        rank == 0
+                        and num_slow_logs[r] > 0
+                        and num_slow_logs[r] % args.straggler_patience == 0
+                    ):
+                        host, host_local_rank = rank_hosts[r]
+                        LOGGER.warning(
+                            f"Rank {r} (local rank {host_local_rank} on {host}) was slower than the median rank in the last {num_slow_logs[r]} logs. Extra ms in the last one: {slow_ranks[r]}"
+                        )
+                state["running_loss"] = _sum_over_cp(running_loss, mesh["cp"]).item()
                 info = {
                     "global_step": state["global_step"],
                     "lr": lr_scheduler.get_last_lr()[0],
                     "running_loss": state["running_loss"] / args.log_freq,
                     "epoch": state["epoch"],
-                    "epoch_progress": state["epoch_step"] / len(dataloader),
-                    "num_batches_remaining": len(dataloader) - i_step,
+                    "epoch_progress": state["epoch_step"] / steps_per_epoch,
+                    "num_batches_remaining": len(dataloader) - i_step * args.grad_accum,
                     "tok/s": 1000 * tok_per_step / ms_per_step,
+                    "tflops_per_device": model_tflops,
+                    "mfu": model_tflops / args.peak_tflops,
+                    "hfu": hardware_tflops / args.peak_tflops,
                     **get_mem_stats(device),
-                    "time/total": sum(t.avg_elapsed_ms() for t in timers.values()),
-                    **{
-                        f"time/{k}": timer.avg_elapsed_ms()
-                        for k, timer in timers.items()
-                    },
+                    "time/total": ms_per_step,
+                    **({"time/compile": compile_ms} if compile_ms is not None else {}),
+                    **{f"time/{k}": ms for k, ms in elapsed_ms.items()},
+                    **get_rank_timing_stats(rank_ms, list(elapsed_ms)),
+                    **profile_info,
                 }
 
                 LOGGER.info(info)
@@ -277,25 +567,410 @@ def main():
 
                 torch.cuda.reset_peak_memory_stats(device)
                 state["running_loss"] = 0
+                running_loss.zero_()
+                profile_info = {}
                 for t in timers.values():
                     t.reset()
 
+            checkpointer.poll()
+
+            tmp_dir = exp_dir / "checkpoints" / f"step-{state['global_step']}.tmp"
             if state["global_step"] % args.ckpt_freq == 0:
+                state["running_loss"] = _sum_over_cp(running_loss, mesh["cp"]).item()
+                if isinstance(train_data, StreamingPackedDataset):
+                    # NOTE: every rank saves its own position in the stream.
+                    tmp_dir.mkdir(parents=True, exist_ok=True)
+                    with open(tmp_dir / f"data-rank-{rank}.json", "w") as fp:
+                        json.dump(train_data.state_dict(), fp)
+            if state["global_step"] % args.ckpt_freq == 0 and args.async_ckpt == "on":
+                LOGGER.info("Starting async checkpoint.")
+                sharded_model_state, sharded_optimizer_state = get_state_dict(
+                    model, optimizer, options=ckpt_opts
+                )
+                checkpointer.save(
+                    dict(model=sharded_model_state, optimizer=sharded_optimizer_state),
+                    checkpoint_id=tmp_dir,
+                    # NOTE: the checkpoint is only published once every rank has finished writing.
+                    on_commit=(
+                        functools.partial(
+                            _finish_checkpoint,
+                            tmp_dir,
+                            copy.deepcopy(state),
+                            copy.deepcopy(lr_scheduler.state_dict()),
+                            keep_last=args.ckpt_keep_last,
+                            keep_every=args.ckpt_keep_every,
+                        )
+                        if is_ckpt_owner
+                        else None
+                    ),
+                )
+            elif state["global_step"] % args.ckpt_freq == 0:
                 LOGGER.info("Saving checkpoint.")
                 dist.barrier()
                 # NOTE: we have to call this on ALL ranks
+                sharded_model_state, sharded_optimizer_state = get_state_dict(
+                    model, optimizer, options=ckpt_opts
+                )
                 DCP.save(
-                    dict(model=model, optimizer=optimizer),
-                    checkpoint_id=exp_dir / "checkpoint",
+                    dict(model=sharded_model_state, optimizer=sharded_optimizer_state),
+                    checkpoint_id=tmp_dir,
                 )
-                if rank == 0:
-                    torch.save(lr_scheduler.state_dict(), exp_dir / "lr_scheduler.pt")
-                    with open(exp_dir / "state.json", "w") as fp:
-                        json.dump(state, fp)
+                # NOTE: every rank has finished writing its shards once save() returns.
+                if is_ckpt_owner:
+                    _finish_checkpoint(
+                        tmp_dir,
+                        state,
+                        lr_scheduler.state_dict(),
+                        keep_last=args.ckpt_keep_last,
+                        keep_every=args.ckpt_keep_every,
+                    )
                 dist.barrier()
 
         state["epoch_step"] = 0
 
+    checkpointer.wait()
+
+
+@torch.no_grad()
+def _sum_over_cp(running_loss, cp_mesh):
+    """
+    Returns `running_loss` summed over the cp ranks, since each of them only has the loss of its
+    own tokens. `running_loss` itself stays local, so logging & checkpointing (which both save
+    the sum) can't count the other ranks' losses twice.
+    """
+    if cp_mesh.size() == 1:
+        return running_loss
+    total = running_loss.clone()
+    dist.all_reduce(total, group=cp_mesh.get_group())
+    return total
+
+
+@torch.no_grad()
+def _all_reduce_grads(model, group):
+    """
+    Sums the gradients of `model` over `group`. The all-reduces are all started before waiting
+    on any of them, so they can overlap.
+    """
+    works = []
+    for param in model.parameters():
+        if param.grad is None:
+            continue
+        grad = param.grad.to_local() if isinstance(param.grad, DTensor) else param.grad
+        works.append(dist.all_reduce(grad, group=group, async_op=True))
+    for work in works:
+        work.wait()
+
+
+@torch.no_grad()
+def _init_weights(model, *, seed, tile_size=1024):
+    """
+    Initializes the weights of a model that was created on the meta device and then
+    `to_empty`'d, in place. Parameters can be plain tensors or DTensors (from
+    parallelize_module/fully_shard), and each rank only generates the values of its own shards,
+    without any communication. A parameter still ends up with the same values however it is
+    sharded, so this gives the same weights as calling it on an unsharded model with the same seed.
+
+    Every parameter is cut into `tile_size` x `tile_size` tiles, and each tile draws from its own
+    generator, seeded from `seed`, the parameter's name and the tile's position. So a value only
+    depends on where it is in the full parameter, not on the order we visit parameters in, or on
+    which ranks hold which shards.
+    """
+    config = model.config
+    for module_name, module in model.named_modules():
+        if isinstance(module, LlamaRotaryEmbedding):
+            # NOTE: to_empty leaves buffers uninitialized too.
+            inv_freq, _ = module.rope_init_fn(module.config, module.inv_freq.device)
+            module.inv_freq.copy_(inv_freq)
+            module.original_inv_freq = module.inv_freq
+        for name, param in module.named_parameters(recurse=False):
+            name = f"{module_name}.{name}" if module_name else name
+            if isinstance(param, DTensor):
+                local = param.to_local()
+                # NOTE: DTensor's shape is the full (unsharded) shape. Our shard is the block of it
+                #       that starts at `offset` (even with fully_shard on top of TP).
+                local_shape, offset = compute_local_shape_and_global_offset(
+                    param.shape, param.device_mesh, param.placements
+                )
+                assert tuple(local.shape) == tuple(local_shape), name
+            else:
+                local, offset = param, (0,) * param.ndim
+            if isinstance(module, LlamaRMSNorm):
+                local.fill_(1.0)
+                continue
+            # NOTE: same distribution as HF's LlamaPreTrainedModel._init_weights
+            _normal_tiles_(
+                local,
+                offset,
+                name=name,
+                seed=seed,
+                std=config.initializer_range,
+                tile_size=tile_size,
+            )
+            if (
+                isinstance(module, torch.nn.Embedding)
+                and module.padding_idx is not None
+            ):
+                row = module.padding_idx - offset[0]
+                if 0 <= row < local.shape[0]:
+                    local[row].zero_()
+
+
+def _normal_tiles_(local, offset, *, name, seed, std, tile_size):
+    """
+    Fills `local`, the block of a 1d or 2d parameter that starts at `offset`, with the values
+    of the tiles that overlap it. A tile is always generated whole, so its values don't depend
+    on how much of it we keep.
+    """
+    assert local.ndim <= 2, f"{name} has {local.ndim} dims"
+    block = local.view(1, -1) if local.ndim == 1 else local
+    row0, col0 = (0, *offset) if local.ndim == 1 else offset
+    num_rows, num_cols = block.shape
+    for ti in range(row0 // tile_size, -(-(row0 + num_rows) // tile_size)):
+        for tj in range(col0 // tile_size, -(-(col0 + num_cols) // tile_size)):
+            generator = torch.Generator(local.device)
+            generator.manual_seed(
+                seed
+                + int(hashlib.md5(f"{name}.{ti}.{tj}".encode()).hexdigest()[:8], 16)
+            )
+            tile = torch.empty(
+                tile_size, tile_size, dtype=local.dtype, device=local.device
+            )
+            tile.normal_(mean=0.0, std=std, generator=generator)
+            # NOTE: the part of the tile inside our block, in full parameter coordinates.
+            r0 = max(row0, ti * tile_size)
+            r1 = min(row0 + num_rows, (ti + 1) * tile_size)
+            c0 = max(col0, tj * tile_size)
+            c1 = min(col0 + num_cols, (tj + 1) * tile_size)
+            block[r0 - row0 : r1 - row0, c0 - col0 : c1 - col0] = tile[
+                r0 - ti * tile_size : r1 - ti * tile_size,
+                c0 - tj * tile_size : c1 - tj * tile_size,
+            ]
+
+
+def _compile_decoder_layers(model, *, cache_dir=None):
+    """
+    torch.compiles the forward of each LlamaDecoderLayer on its own. All of the layers run the
+    same code, so they share the compiled graphs. Compiling is lazy, it happens during the first
+    forward & backward.
+    """
+    if cache_dir is not None:
+        # NOTE: inductor (and triton) cache the compiled kernels here. On node-local disk, a
+        #       restarted run reuses them instead of compiling everything again.
+        os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_dir
+    for module in model.modules():
+        if isinstance(module, LlamaDecoderLayer):
+            # NOTE: compiling `forward` (instead of the module) keeps hooks on the layer itself,
+            #       like FSDP's all-gathers, out of the compiled graph. It also leaves the
+            #       parameter names (and so the checkpoints) unchanged.
+            module.forward = torch.compile(module.forward)
+
+
+# NOTE: the GPU kernels NCCL launches are named like `ncclDevKernel_AllGather_RING_LL`.
+#       All-to-all and pipeline sends/receives both run as SendRecv kernels.
+NCCL_KERNEL_TYPES = {
+    "AllGather": "all_gather",
+    "ReduceScatter": "reduce_scatter",
+    "AllReduce": "all_reduce",
+    "Broadcast": "broadcast",
+    "Reduce": "reduce",
+    "SendRecv": "send_recv",
+    "Send": "send_recv",
+    "Recv": "send_recv",
+}
+DTYPE_BYTES = {
+    "double": 8,
+    "float": 4,
+    "half": 2,
+    "bfloat16": 2,
+    "float8_e4m3fn": 1,
+    "float8_e5m2": 1,
+    "long": 8,
+    "int": 4,
+    "char": 1,
+    "byte": 1,
+    "bool": 1,
+}
+
+
+def _collective_type(kernel_name, collective_name):
+    name = collective_name.lower().replace("_", "")
+    for key, kind in [
+        ("allgather", "all_gather"),
+        ("reducescatter", "reduce_scatter"),
+        ("allreduce", "all_reduce"),
+        ("alltoall", "all_to_all"),
+        ("broadcast", "broadcast"),
+        ("send", "send_recv"),
+        ("recv", "send_recv"),
+    ]:
+        if key in name:
+            return kind
+    match = re.match(r"nccl(?:Dev)?Kernel_([A-Za-z]+)", kernel_name)
+    return NCCL_KERNEL_TYPES.get(match.group(1), "other") if match else "other"
+
+
+def _bus_bytes(kind, args):
+    """
+    The bytes each rank sends over the wire for one collective, from the message size the
+    profiler records for it. Same as nccl-tests' "bus bandwidth", so the result can be
+    compared to the hardware's peak.
+    """
+    dtype_bytes = DTYPE_BYTES.get(str(args.get("dtype", "")).split("::")[-1].lower())
+    if dtype_bytes is None or "In msg nelems" not in args:
+        return None
+    in_bytes = int(args["In msg nelems"]) * dtype_bytes
+    out_bytes = int(args.get("Out msg nelems", 0)) * dtype_bytes
+    n = int(args.get("Group size", 1))
+    if kind == "all_reduce":
+        return 2 * (n - 1) / n * in_bytes
+    if kind == "all_gather":
+        return (n - 1) / n * out_bytes
+    if kind == "reduce_scatter":
+        return (n - 1) / n * in_bytes
+    return max(in_bytes, out_bytes)
+
+
+def _merge_spans(spans):
+    merged = []
+    for start, end in sorted(spans):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def _overlap(a, b):
+    total, i, j = 0.0, 0, 0
+    while i < len(a) and j < len(b):
+        total += max(0.0, min(a[i][1], b[j][1]) - max(a[i][0], b[j][0]))
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return total
+
+
+def summarize_trace(path, *, num_steps):
+    """
+    Reads the GPU kernels out of a chrome trace written by torch.profiler, and returns the
+    time per step spent computing & communicating, split up by collective type.
+    """
+    with open(path) as fp:
+        events = json.load(fp)["traceEvents"]
+
+    compute_spans, comm_spans = [], []
+    per_type = collections.defaultdict(collections.Counter)
+    for event in events:
+        if event.get("ph") != "X" or event.get("cat") != "kernel":
+            continue
+        span = (event["ts"], event["ts"] + event["dur"])
+        if not event["name"].startswith("nccl"):
+            compute_spans.append(span)
+            continue
+        comm_spans.append(span)
+        args = event.get("args", {})
+        kind = _collective_type(event["name"], args.get("Collective name", ""))
+        stats = per_type[kind]
+        stats["us"] += event["dur"]
+        stats["count"] += 1
+        bus_bytes = _bus_bytes(kind, args)
+        if bus_bytes is not None:
+            stats["bus_bytes"] += bus_bytes
+            stats["sized_us"] += event["dur"]
+
+    # NOTE: collectives on different streams can run at the same time (and overlap with compute),
+    #       so the totals are the time at least one kernel was running, not the sum of the kernels.
+    compute_spans = _merge_spans(compute_spans)
+    comm_spans = _merge_spans(comm_spans)
+    compute_us = sum(end - start for start, end in compute_spans)
+    comm_us = sum(end - start for start, end in comm_spans)
+    exposed_us = comm_us - _overlap(comm_spans, compute_spans)
+    info = {
+        "profile/compute_ms": compute_us / 1000 / num_steps,
+        "profile/comm_ms": comm_us / 1000 / num_steps,
+        "profile/exposed_comm_ms": exposed_us / 1000 / num_steps,
+    }
+    for kind, stats in sorted(per_type.items()):
+        info[f"profile/{kind}_ms"] = stats["us"] / 1000 / num_steps
+        info[f"profile/{kind}_count"] = stats["count"] / num_steps
+        if stats["sized_us"] > 0:
+            info[f"profile/{kind}_gb"] = 1e-9 * stats["bus_bytes"] / num_steps
+            # NOTE: bytes per microsecond to GB/s.
+            info[f"profile/{kind}_busbw_gbps"] = (
+                1e-3 * stats["bus_bytes"] / stats["sized_us"]
+            )
+    return info
+
+
+def get_flops_per_token(config, seq_length):
+    """
+    FLOPs of the forward pass of a llama model, per token. Only counts the matmuls (2 FLOPs per
+    multiply-add), since everything else is tiny in comparison. Returns the FLOPs of the
+    attention & mlp of a single decoder layer, and of the whole model.
+    """
+    head_dim = getattr(config, "head_dim", None) or (
+        config.hidden_size // config.num_attention_heads
+    )
+    q_and_o = 2 * config.hidden_size * config.num_attention_heads * head_dim
+    k_and_v = 2 * config.hidden_size * config.num_key_value_heads * head_dim
+    # NOTE: every token's query is multiplied with seq_length keys, and the scores with seq_length
+    #       values. We count all of them like PaLM's MFU does, even though a causal mask skips half.
+    scores = 2 * seq_length * config.num_attention_heads * head_dim
+    attn = 2 * (q_and_o + k_and_v + scores)
+    mlp = 2 * 3 * config.hidden_size * config.intermediate_size
+    lm_head = 2 * config.hidden_size * config.vocab_size
+    return {
+        "attn": attn,
+        "mlp": mlp,
+        "total": config.num_hidden_layers * (attn + mlp) + lm_head,
+    }
+
+
+def gather_rank_timings(elapsed_ms, device):
+    """
+    All-gathers the time every rank spent in each phase. Returns a (world_size, num_phases)
+    tensor on the cpu.
+    """
+    local = torch.tensor(list(elapsed_ms.values()), dtype=torch.float32, device=device)
+    gathered = torch.empty(
+        dist.get_world_size() * local.numel(), dtype=local.dtype, device=device
+    )
+    dist.all_gather_into_tensor(gathered, local)
+    return gathered.view(dist.get_world_size(), -1).cpu()
+
+
+def get_rank_timing_stats(rank_ms, names):
+    info = {}
+    rank_ms = torch.cat([rank_ms, rank_ms.sum(dim=1, keepdim=True)], dim=1)
+    for name, ms in zip(names + ["total"], rank_ms.T):
+        info[f"ranks/{name}_min"] = ms.min().item()
+        info[f"ranks/{name}_median"] = ms.median().item()
+        info[f"ranks/{name}_max"] = ms.max().item()
+        info[f"ranks/{name}_max_rank"] = ms.argmax().item()
+    return info
+
+
+def find_slow_ranks(rank_ms, names, *, threshold):
+    """
+    The ranks that took longer than the median rank in some phase, by more than `threshold` times
+    the median step. Returns {rank: {phase: extra ms}}.
+    """
+    median = rank_ms.median(dim=0).values
+    extra = rank_ms - median
+    is_slow = extra > threshold * median.sum()
+    slow_phases = is_slow.any(dim=0).nonzero().flatten().tolist()
+    if len(slow_phases) == 0:
+        return {}
+    # NOTE: the other ranks wait for a slow rank in their next collective, which makes *them* look
+    #       slow in a later phase. So we only blame the ranks in the first phase (in step order)
+    #       that anyone was slow in.
+    i = slow_phases[0]
+    return {
+        r: {names[i]: round(extra[r, i].item(), 1)}
+        for r in is_slow[:, i].nonzero().flatten().tolist()
+    }
+
 
 def get_mem_stats(device=None):
     mem = torch.cuda.memory_stats(device)
@@ -309,60 +984,531 @@ def get_mem_stats(device=None):
     }
 
 
-def _load_and_preprocess_data(args, config):
+def _load_and_preprocess_data(args, config, *, is_builder):
+    """
+    Tokenizes & packs the dataset into `seq_length` blocks on a single process (`is_builder`),
+    in the same format as related-topics/optimizing-data-loading/pack_dataset.py, and then every
+    process memory maps the result with PackedDataset.
+
+    The output directory is named after a fingerprint of the arguments that determine its contents,
+    and only appears once it is complete, so the other processes just wait for it (and later runs
+    skip straight to loading it). If the builder fails, it leaves a `<fingerprint>.failed` marker
+    instead, and the other processes fail too.
+    """
+    if (Path(args.dataset_name) / "index.json").exists():
+        # NOTE: this is a directory created by pack_dataset.py, which is already tokenized & grouped.
+        return PackedDataset(args.dataset_name, seq_length=args.seq_length)
+
+    fingerprint = hashlib.sha256(
+        json.dumps(
+            [args.dataset_name, args.model_name, args.seq_length, args.packing]
+        ).encode()
+    ).hexdigest()[:16]
+    output_dir = Path(datasets.config.HF_DATASETS_CACHE) / "packed" / fingerprint
+
+    failed_marker = output_dir.with_name(f"{fingerprint}.failed")
+    if is_builder:
+        # NOTE: left over from an earlier run. The barrier makes sure nobody sees it before it's gone.
+        failed_marker.unlink(missing_ok=True)
+    dist.barrier()
+
+    if is_builder and not output_dir.exists():
+        try:
+            _pack_data(args, config, output_dir)
+        except Exception:
+            failed_marker.parent.mkdir(parents=True, exist_ok=True)
+            failed_marker.touch()
+            raise
+
+    # NOTE: we don't use a barrier here, because preprocessing a big dataset can easily take
+    #       longer than the collective timeout.
+    while not output_dir.exists():
+        if failed_marker.exists():
+            raise RuntimeError(
+                f"Preprocessing the dataset into {output_dir} failed on another process, see its logs."
+            )
+        time.sleep(1)
+
+    return PackedDataset(output_dir)
+
+
+def _pack_data(args, config, output_dir):
     """
     Function created using code found in
     https://github.com/huggingface/transformers/blob/v4.45.1/examples/pytorch/language-modeling/run_clm_no_trainer.py
     """
     tokenizer = AutoTokenizer.from_pretrained(args.model_name)
 
-    data = datasets.load_dataset(args.dataset_name, trust_remote_code=True)
+    seq_length = args.seq_length or tokenizer.model_max_length
+    if seq_length > config.max_position_embeddings:
+        seq_length = min(1024, config.max_position_embeddings)
+
+    # NOTE: uint16 halves the size on disk (and in the page cache) for any vocab that fits.
+    dtype = np.uint16 if len(tokenizer) <= np.iinfo(np.uint16).max + 1 else np.uint32
 
-    column_names = data["train"].column_names
+    data = datasets.load_dataset(
+        args.dataset_name, split="train", trust_remote_code=True
+    )
+
+    column_names = data.column_names
     text_column_name = "text" if "text" in column_names else column_names[0]
 
     def tokenize_function(examples):
-        return tokenizer(examples[text_column_name])
+        return tokenizer(examples[text_column_name], return_attention_mask=False)
 
-    tokenized_datasets = data.map(
+    tokenized = data.map(
         tokenize_function,
         batched=True,
         remove_columns=column_names,
-        num_proc=multiprocessing.cpu_count(),
+        # NOTE: we are the only process on the node doing this, so we can use all the cores we are allowed to run on.
+        num_proc=args.preprocess_workers or len(os.sched_getaffinity(0)),
         load_from_cache_file=True,
         desc="Running tokenizer on dataset",
     )
 
-    seq_length = args.seq_length or tokenizer.model_max_length
-    if seq_length > config.max_position_embeddings:
-        seq_length = min(1024, config.max_position_embeddings)
+    tmp_dir = output_dir.with_name(output_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+
+    shard = {"path": "shard-00000.bin", "num_blocks": 0}
+    if args.packing == "best-fit":
+        shard["position_ids_path"] = "shard-00000.position_ids.bin"
+    position_ids_dtype = np.uint16 if seq_length <= 2**16 else np.uint32
+
+    # NOTE: Instead of building python lists like `group_texts` does, we pull the token ids
+    #       straight out of the underlying arrow table, and append every full block to disk.
+    leftover = np.empty(0, dtype=dtype)
+    for table in tqdm.tqdm(
+        tokenized.with_format("arrow").iter(batch_size=10_000),
+        desc=f"Packing into blocks of {seq_length}",
+    ):
+        tokens = pc.list_flatten(table["input_ids"]).to_numpy().astype(dtype)
+        if args.packing == "best-fit":
+            input_ids, position_ids = _best_fit_pack(
+                tokens,
+                pc.list_value_length(table["input_ids"]).to_numpy(),
+                seq_length,
+                # NOTE: padding is never attended to by real tokens, and never predicted, so any id works.
+                pad_id=0,
+            )
+            with open(tmp_dir / shard["position_ids_path"], "ab") as fp:
+                position_ids.astype(position_ids_dtype).tofile(fp)
+        else:
+            # NOTE: Like `group_texts`, we drop the final remainder that doesn't fill a whole block.
+            tokens = np.concatenate([leftover, tokens])
+            n = len(tokens) // seq_length
+            input_ids = tokens[: n * seq_length].reshape(n, seq_length)
+            leftover = tokens[n * seq_length :]
+        with open(tmp_dir / shard["path"], "ab") as fp:
+            input_ids.tofile(fp)
+        shard["num_blocks"] += len(input_ids)
+
+    index = {
+        "dataset_name": args.dataset_name,
+        "split": "train",
+        "model_name": args.model_name,
+        "seq_length": seq_length,
+        "packing": args.packing,
+        "dtype": np.dtype(dtype).name,
+        "position_ids_dtype": np.dtype(position_ids_dtype).name,
+        "num_blocks": shard["num_blocks"],
+        "shards": [shard],
+    }
+    with open(tmp_dir / "index.json", "w") as fp:
+        json.dump(index, fp, indent=2)
 
-    # Main data processing function that will concatenate all texts from our dataset and generate chunks of block_size.
-    def group_texts(examples):
-        # Concatenate all texts.
-        concatenated_examples = {k: list(chain(*examples[k])) for k in examples.keys()}
-        total_length = len(concatenated_examples[list(examples.keys())[0]])
-        # We drop the small remainder, and if the total_length < block_size  we exclude this batch and return an empty dict.
-        # We could add padding if the model supported it instead of this drop, you can customize this part to your needs.
-        if total_length > seq_length:
-            total_length = (total_length // seq_length) * seq_length
-        # Split by chunks of max_len.
-        result = {
-            k: [t[i : i + seq_length] for i in range(0, total_length, seq_length)]
-            for k, t in concatenated_examples.items()
+    # NOTE: renaming a directory is atomic, so `output_dir` is either complete or doesn't exist.
+    os.replace(tmp_dir, output_dir)
+    LOGGER.info(f"Packed {index['num_blocks']} blocks into {output_dir}")
+
+
+def _best_fit_pack(tokens, lengths, seq_length, pad_id):
+    """
+    Packs whole documents into `seq_length` blocks, putting each one into the fullest block that
+    still has room for it (best-fit decreasing), and pads whatever room is left at the end of each
+    block. Documents longer than `seq_length` are split into `seq_length` chunks first.
+
+    Returns the input ids & position ids of the blocks. The position ids restart at 0 for every
+    document, and are 0 for every padding token.
+    """
+    starts, sizes = [], []
+    offset = 0
+    for length in lengths:
+        for i in range(0, length, seq_length):
+            starts.append(offset + i)
+            sizes.append(min(seq_length, length - i))
+        offset += length
+
+    blocks = []
+    # NOTE: sorted by room left, so bisect finds the fullest block the chunk still fits in.
+    room_left = []
+    for j in sorted(range(len(sizes)), key=lambda j: sizes[j], reverse=True):
+        i = bisect.bisect_left(room_left, (sizes[j], -1))
+        if i < len(room_left):
+            room, b = room_left.pop(i)
+        else:
+            room, b = seq_length, len(blocks)
+            blocks.append([])
+        blocks[b].append(j)
+        if room > sizes[j]:
+            bisect.insort(room_left, (room - sizes[j], b))
+
+    input_ids = np.full((len(blocks), seq_length), pad_id, dtype=tokens.dtype)
+    position_ids = np.zeros((len(blocks), seq_length), dtype=np.int64)
+    for b, chunks in enumerate(blocks):
+        offset = 0
+        for j in chunks:
+            input_ids[b, offset : offset + sizes[j]] = tokens[
+                starts[j] : starts[j] + sizes[j]
+            ]
+            position_ids[b, offset : offset + sizes[j]] = np.arange(sizes[j])
+            offset += sizes[j]
+    return input_ids, position_ids
+
+
+class PackedDataset(torch.utils.data.Dataset):
+    """
+    Reads the fixed `seq_length` blocks of token ids written by
+    related-topics/optimizing-data-loading/pack_dataset.py.
+
+    The shards are memory mapped, so nothing is loaded up front, and every sample is a view
+    directly into the page cache (no copies are made until the batch is collated).
+    """
+
+    def __init__(self, path, seq_length=None):
+        self.path = Path(path)
+        with open(self.path / "index.json") as fp:
+            self.index = json.load(fp)
+        if seq_length is not None and seq_length != self.index["seq_length"]:
+            raise ValueError(
+                f"{self.path} was packed with seq_length={self.index['seq_length']}, but seq_length={seq_length} was requested."
+            )
+        self.seq_length = self.index["seq_length"]
+        self.offsets = np.cumsum([0] + [s["num_blocks"] for s in self.index["shards"]])
+        # NOTE: opened lazily so each DataLoader worker process creates its own memory maps.
+        self.shards = None
+        self.position_ids = None
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, i):
+        if self.shards is None:
+            self.shards = [
+                # NOTE: mode="c" is copy-on-write, so the views are writable (which torch wants) but the files are never modified.
+                np.memmap(
+                    self.path / s["path"], dtype=self.index["dtype"], mode="c"
+                ).reshape(-1, self.seq_length)
+                for s in self.index["shards"]
+            ]
+            # NOTE: only written by `--packing best-fit`, where each document has its own positions.
+            self.position_ids = [
+                (
+                    np.memmap(
+                        self.path / s["position_ids_path"],
+                        dtype=self.index["position_ids_dtype"],
+                        mode="c",
+                    ).reshape(-1, self.seq_length)
+                    if "position_ids_path" in s
+                    else None
+                )
+                for s in self.index["shards"]
+            ]
+        shard = int(np.searchsorted(self.offsets, i, side="right")) - 1
+        sample = {
+            "input_ids": torch.from_numpy(self.shards[shard][i - self.offsets[shard]])
         }
-        result["labels"] = result["input_ids"].copy()
-        return result
+        if self.position_ids[shard] is not None:
+            sample["position_ids"] = torch.from_numpy(
+                self.position_ids[shard][i - self.offsets[shard]]
+            )
+        return sample
 
-    lm_datasets = tokenized_datasets.map(
-        group_texts,
-        batched=True,
-        num_proc=multiprocessing.cpu_count(),
-        load_from_cache_file=True,
-        desc=f"Grouping texts in chunks of {seq_length}",
+    def __getstate__(self):
+        return {**self.__dict__, "shards": None, "position_ids": None}
+
+
+def packed_data_collator(samples):
+    input_ids = torch.stack([s["input_ids"] for s in samples]).long()
+    # NOTE: labels are just the input_ids (the model shifts them internally), so we don't store them twice.
+    batch = {"input_ids": input_ids, "labels": input_ids}
+    if "position_ids" in samples[0]:
+        # NOTE: every document (and every padding token) starts at position 0. We don't want to
+        #       predict the start of a document from the end of the previous one, or any padding.
+        position_ids = torch.stack([s["position_ids"] for s in samples]).long()
+        batch["position_ids"] = position_ids
+        batch["labels"] = input_ids.masked_fill(position_ids == 0, -100)
+    if "data_state" in samples[-1]:
+        # NOTE: a batch always comes from a single worker, so the last sample has its latest state.
+        batch["data_state"] = samples[-1]["data_state"]
+    return batch
+
+
+class StreamingPackedDataset(torch.utils.data.IterableDataset):
+    """
+    Streams documents (instead of downloading the whole dataset up front), and tokenizes & packs
+    them into `seq_length` blocks on the fly. So the time to the first step doesn't depend on the
+    size of the dataset.
+
+    Every (rank, DataLoader worker) pair reads its own shard of the documents. Blocks are shuffled
+    in windows of `shuffle_buffer` blocks, with a seed derived from the window's position, and the
+    stream starts over (with a different shuffle) once it runs out.
+
+    Each sample carries the state of its worker at the start of its window, plus how far into the
+    window it is. So resuming only has to re-read (at most) one window of documents.
+    """
+
+    def __init__(self, args, *, rank, num_replicas, num_blocks):
+        self.dataset_name = args.dataset_name
+        self.model_name = args.model_name
+        self.seq_length = args.seq_length
+        self.shuffle_buffer = args.shuffle_buffer
+        self.seed = args.seed
+        self.rank = rank
+        self.num_replicas = num_replicas
+        self.num_blocks = num_blocks
+        self.worker_states = {}
+        self.next_worker = 0
+
+    def __len__(self):
+        # NOTE: the stream never runs out, so an "epoch" is however many blocks we were told.
+        return self.num_blocks
+
+    def state_dict(self):
+        return {"worker_states": self.worker_states, "next_worker": self.next_worker}
+
+    def load_state_dict(self, state_dict):
+        self.worker_states = state_dict["worker_states"]
+        self.next_worker = state_dict["next_worker"]
+
+    def update_state(self, data_state):
+        self.worker_states[str(data_state["worker"])] = data_state
+        self.next_worker = data_state["worker"] + 1
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id = 0 if worker_info is None else worker_info.id
+        num_workers = 1 if worker_info is None else worker_info.num_workers
+
+        # NOTE: the DataLoader always gets the first batch from worker 0, so after resuming we
+        #       rotate which part of the stream each worker reads to keep the same order of batches.
+        worker = (worker_id + self.next_worker) % num_workers
+        num_shards = self.num_replicas * num_workers
+        shard = self.rank * num_workers + worker
+
+        state = self.worker_states.get(
+            str(worker),
+            {
+                "worker": worker,
+                "num_shards": num_shards,
+                "pass": 0,
+                "window": 0,
+                "offset": 0,
+                "source": None,
+                "tokens": [],
+            },
+        )
+        if state["num_shards"] != num_shards:
+            raise ValueError(
+                f"Stream was split into {state['num_shards']} shards, but we now have {num_shards} (num_replicas * num_workers)."
+            )
+
+        tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+
+        while True:
+            source = datasets.load_dataset(
+                self.dataset_name, split="train", streaming=True, trust_remote_code=True
+            )
+            source = split_dataset_by_node(source, rank=shard, world_size=num_shards)
+            if state["source"] is not None:
+                source.load_state_dict(state["source"])
+            # NOTE: `.iter()` instead of `iter()`, because iter() notices it is in a DataLoader worker
+            #       and splits the data across workers again (we already did that above).
+            documents = source.iter(batch_size=1)
+
+            while True:
+                state["source"] = copy.deepcopy(source.state_dict())
+                tokens = list(state["tokens"])
+                blocks = []
+                for document in documents:
+                    text = (
+                        document["text"]
+                        if "text" in document
+                        else next(iter(document.values()))
+                    )
+                    tokens.extend(tokenizer(text[0])["input_ids"])
+                    while len(tokens) >= self.seq_length:
+                        blocks.append(tokens[: self.seq_length])
+                        del tokens[: self.seq_length]
+                    if len(blocks) >= self.shuffle_buffer:
+                        break
+                if len(blocks) == 0:
+                    break
+
+                rng = random.Random(
+                    f"{self.seed}-{state['pass']}-{shard}-{state['window']}"
+                )
+                rng.shuffle(blocks)
+                for i in range(state["offset"], len(blocks)):
+                    yield {
+                        "input_ids": torch.tensor(blocks[i]),
+                        "data_state": {**state, "offset": i + 1},
+                    }
+
+                state = {
+                    **state,
+                    "window": state["window"] + 1,
+                    "offset": 0,
+                    "tokens": tokens,
+                }
+
+            # NOTE: leftover tokens that don't fill a block are dropped, like `group_texts` does.
+            state = {
+                **state,
+                "pass": state["pass"] + 1,
+                "window": 0,
+                "source": None,
+                "tokens": [],
+            }
+
+
+class ResumableDistributedSampler(DistributedSampler):
+    """
+    A DistributedSampler that can start part way through an epoch.
+
+    The normal DistributedSampler always starts at the beginning of the epoch, so resuming means
+    loading, collating, and moving to the GPU every batch we already trained on. Instead, we just
+    drop the indices of those batches before the DataLoader ever sees them.
+
+    NOTE: `len()` still reports the full epoch, so `len(dataloader)` keeps meaning batches per epoch.
+    """
+
+    def __init__(self, dataset, *, batch_size, **kwargs):
+        super().__init__(dataset, **kwargs)
+        self.batch_size = batch_size
+        self.start_step = 0
+
+    def set_epoch(self, epoch, start_step=0):
+        super().set_epoch(epoch)
+        self.start_step = start_step
+
+    def __iter__(self):
+        indices = list(super().__iter__())
+        return iter(indices[self.start_step * self.batch_size :])
+
+
+def _checkpoint_step(ckpt_dir):
+    return int(ckpt_dir.name.split("-")[1])
+
+
+def _get_latest_checkpoint(ckpt_root):
+    # NOTE: checkpoints are written to `step-N.tmp` and only renamed to `step-N` once they are
+    #       complete, so every `step-N` directory is a complete checkpoint.
+    ckpt_dirs = [p for p in ckpt_root.glob("step-*") if p.name.split("-")[1].isdigit()]
+    if len(ckpt_dirs) == 0:
+        return None
+    return max(ckpt_dirs, key=_checkpoint_step)
+
+
+def _commit_checkpoint(tmp_dir, *, keep_last, keep_every):
+    """
+    Publishes a fully written `step-N.tmp` directory as `step-N` with an atomic rename, and
+    points `latest` at it. Then deletes (in the background) any checkpoints that fall outside
+    of the retention policy, along with leftovers from saves that crashed part way through.
+    """
+    ckpt_root = tmp_dir.parent
+    ckpt_dir = tmp_dir.with_suffix("")
+    if ckpt_dir.exists():
+        shutil.rmtree(ckpt_dir)
+    tmp_dir.rename(ckpt_dir)
+
+    with open(ckpt_root / "latest.tmp", "w") as fp:
+        fp.write(ckpt_dir.name)
+    os.replace(ckpt_root / "latest.tmp", ckpt_root / "latest")
+    LOGGER.info(f"Committed checkpoint {ckpt_dir}")
+
+    ckpt_dirs = sorted(
+        [p for p in ckpt_root.glob("step-*") if p.name.split("-")[1].isdigit()],
+        key=_checkpoint_step,
     )
+    expired = [
+        p
+        for p in ckpt_dirs[:-keep_last]
+        if keep_every <= 0 or _checkpoint_step(p) % keep_every != 0
+    ]
+    # NOTE: a `.tmp` from an earlier step is left over from a save that crashed. Later ones are still
+    #       being written (e.g. the data positions of the next checkpoint, while this one committed
+    #       asynchronously), so we leave those alone.
+    stale_tmp_dirs = [
+        p
+        for p in ckpt_root.glob("step-*.tmp")
+        if _checkpoint_step(p.with_suffix("")) < _checkpoint_step(ckpt_dir)
+    ]
+    # NOTE: renaming before deleting means a half deleted checkpoint never looks complete.
+    to_delete = stale_tmp_dirs + list(ckpt_root.glob("step-*.deleting"))
+    for p in expired:
+        to_delete.append(p.rename(p.with_name(p.name + ".deleting")))
+    threading.Thread(
+        target=lambda: [shutil.rmtree(p, ignore_errors=True) for p in to_delete],
+        daemon=True,
+    ).start()
+
+
+class AsyncCheckpointer:
+    """
+    Writes DCP checkpoints from a background thread, with at most one save in flight.
+
+    The training loop only pays for copying the (sharded) state into CPU memory, writing it to
+    disk overlaps with the next training steps. `on_commit` (if given) runs in the main thread
+    once the save has finished on every rank, which is when it is safe to write our commit
+    marker (state.json).
+    """
 
-    return lm_datasets["train"]
+    def __init__(self):
+        self.future = None
+        self.on_commit = None
+
+    def save(self, state_dict, *, checkpoint_id, on_commit):
+        self.wait()
+        staged_state_dict = _snapshot_to_cpu(state_dict)
+        torch.cuda.synchronize()
+        self.future = async_save(staged_state_dict, checkpoint_id=checkpoint_id)
+        self.on_commit = on_commit
+
+    def poll(self):
+        if self.future is not None and self.future.done():
+            self.wait()
+
+    def wait(self):
+        if self.future is None:
+            return
+        # NOTE: this re-raises any error that happened while writing.
+        self.future.result()
+        on_commit = self.on_commit
+        self.future = None
+        self.on_commit = None
+        if on_commit is not None:
+            on_commit()
+
+
+def _snapshot_to_cpu(obj):
+    if isinstance(obj, torch.Tensor):
+        # NOTE: copying from the GPU with non_blocking=True allocates the destination in pinned memory,
+        #       and the caching host allocator hands us the same pinned buffers again on the next save.
+        #       This also works for DTensor/ShardedTensor, which keep their sharding metadata.
+        return obj.detach().to("cpu", non_blocking=True, copy=True)
+    if isinstance(obj, dict):
+        return {k: _snapshot_to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot_to_cpu(v) for v in obj)
+    return obj
+
+
+def _finish_checkpoint(tmp_dir, state, lr_scheduler_state, *, keep_last, keep_every):
+    torch.save(lr_scheduler_state, tmp_dir / "lr_scheduler.pt")
+    with open(tmp_dir / "state.json", "w") as fp:
+        json.dump(state, fp)
+    _commit_checkpoint(tmp_dir, keep_last=keep_last, keep_every=keep_every)
 
 
 @contextmanager
@@ -375,33 +1521,157 @@ def rank_ordered(*, should_go_first: bool):
     dist.barrier()
 
 
+class DevicePrefetcher:
+    """
+    Wraps an iterator of batches, and keeps the next `num_batches` of them in flight to `device`,
+    so the training loop gets batches that are already there.
+
+    On a GPU, the (pinned) batches are copied on a separate stream with `non_blocking=True`, which
+    overlaps the copies with the compute of the current step. On a CPU there is nothing to copy, so
+    a background thread just loads the next batches ahead of time instead.
+    """
+
+    def __init__(self, batches, device, num_batches=2):
+        self.batches = iter(batches)
+        self.device = device
+        if device.type == "cuda":
+            self.stream = torch.cuda.Stream(device=device)
+            self.ready = collections.deque()
+            for _ in range(num_batches):
+                self._copy_next()
+        else:
+            self.ready = queue.Queue(maxsize=num_batches)
+            # NOTE: the thread doesn't hold a reference to us, so once the training loop drops us we
+            #       can tell it to stop (and let go of the DataLoader workers).
+            self.stop = threading.Event()
+            threading.Thread(
+                target=self._load_in_background,
+                args=(self.batches, device, self.ready, self.stop),
+                daemon=True,
+            ).start()
+
+    def __del__(self):
+        if self.device.type != "cuda":
+            self.stop.set()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.device.type != "cuda":
+            batch = self.ready.get()
+            if isinstance(batch, BaseException):
+                raise batch
+            return batch
+
+        if len(self.ready) == 0:
+            raise StopIteration
+        batch, copied = self.ready.popleft()
+        stream = torch.cuda.current_stream(self.device)
+        stream.wait_event(copied)
+        for v in batch.values():
+            if isinstance(v, torch.Tensor):
+                # NOTE: this memory was allocated on our side stream, so we tell the caching allocator
+                #       not to reuse it until the compute stream is done with it too.
+                v.record_stream(stream)
+        self._copy_next()
+        return batch
+
+    def _copy_next(self):
+        try:
+            batch = next(self.batches)
+        except StopIteration:
+            return
+        with torch.cuda.stream(self.stream):
+            batch = {
+                k: (
+                    v.to(self.device, non_blocking=True)
+                    if isinstance(v, torch.Tensor)
+                    else v
+                )
+                for k, v in batch.items()
+            }
+            copied = torch.cuda.Event()
+            copied.record(self.stream)
+        self.ready.append((batch, copied))
+
+    @staticmethod
+    def _load_in_background(batches, device, ready, stop):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    ready.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for batch in batches:
+                batch = {
+                    k: v.to(device) if isinstance(v, torch.Tensor) else v
+                    for k, v in batch.items()
+                }
+                if not put(batch):
+                    return
+            put(StopIteration())
+        except Exception as err:
+            put(err)
+
+
 class LocalTimer:
-    def __init__(self, device: torch.device):
+    """
+    By default this just records a pair of CUDA events around each block, and only waits for them
+    when `avg_elapsed_ms()` is called (i.e. every `--log-freq` steps), so the CPU can keep queueing
+    up work for the GPU. With `sync=True` it synchronizes the device before & after each block
+    instead, which makes each measurement exact but stalls the GPU - only useful for debugging.
+    """
+
+    def __init__(self, device: torch.device, sync: bool = False):
         if device.type == "cpu":
             self.synchronize = lambda: torch.cpu.synchronize(device=device)
         elif device.type == "cuda":
             self.synchronize = lambda: torch.cuda.synchronize(device=device)
+        # NOTE: there is nothing asynchronous to wait for on CPU, so we just read the clock.
+        self.use_events = device.type == "cuda" and not sync
+        self.sync = sync
         self.measurements = []
-        self.start_time = None
+        self.pending_events = []
+        self.start = None
 
     def __enter__(self):
-        self.synchronize()
-        self.start_time = time.time()
+        if self.use_events:
+            self.start = torch.cuda.Event(enable_timing=True)
+            self.start.record()
+        else:
+            if self.sync:
+                self.synchronize()
+            self.start = time.time()
         return self
 
     def __exit__(self, type, value, traceback):
         if traceback is None:
-            self.synchronize()
-            end_time = time.time()
-            self.measurements.append(end_time - self.start_time)
-        self.start_time = None
+            if self.use_events:
+                end = torch.cuda.Event(enable_timing=True)
+                end.record()
+                self.pending_events.append((self.start, end))
+            else:
+                if self.sync:
+                    self.synchronize()
+                self.measurements.append(1000 * (time.time() - self.start))
+        self.start = None
 
     def avg_elapsed_ms(self):
-        return 1000 * (sum(self.measurements) / len(self.measurements))
+        if len(self.pending_events) > 0:
+            self.pending_events[-1][1].synchronize()
+            self.measurements.extend(s.elapsed_time(e) for s, e in self.pending_events)
+            self.pending_events = []
+        return sum(self.measurements) / len(self.measurements)
 
     def reset(self):
         self.measurements = []
-        self.start_time = None
+        self.pending_events = []
+        self.start = None
 
 
 def _get_parser() -> argparse.ArgumentParser:
@@ -413,10 +1683,160 @@ def _get_parser() -> argparse.ArgumentParser:
     parser.add_argument("--seed", default=0, type=int)
     parser.add_argument("--num-epochs", default=100, type=int)
     parser.add_argument("--lr", default=3e-5, type=float)
+    parser.add_argument(
+        "--master-dtype",
+        default="bf16",
+        choices=["bf16", "fp32"],
+        help="dtype of the weights the optimizer updates.",
+    )
+    parser.add_argument(
+        "--param-dtype",
+        default=None,
+        choices=["bf16", "fp32"],
+        help="dtype that forward & backward run in. Defaults to --master-dtype.",
+    )
+    parser.add_argument(
+        "--buffer-dtype",
+        default=None,
+        choices=["bf16", "fp32"],
+        help="dtype for floating point buffers (like the rotary embedding's inv_freq). Defaults to leaving them as the model creates them.",
+    )
+    parser.add_argument(
+        "--cp",
+        default=1,
+        type=int,
+        help="Context parallel size: splits each sequence across this many groups of each node's GPUs, with ring attention between them.",
+    )
     parser.add_argument("-b", "--batch-size", default=1, type=int)
+    parser.add_argument(
+        "--grad-accum",
+        default=1,
+        type=int,
+        help="Number of batches to accumulate gradients over for each optimizer step.",
+    )
     parser.add_argument("--log-freq", default=100, type=int)
+    parser.add_argument(
+        "--device-prefetch",
+        default=2,
+        type=int,
+        help="Number of batches copied to the device ahead of time.",
+    )
+    parser.add_argument(
+        "--timer-mode",
+        default="events",
+        choices=["events", "sync"],
+        help="sync waits for the GPU around every timed block, which is exact but slow.",
+    )
     parser.add_argument("--ckpt-freq", default=500, type=int)
+    parser.add_argument(
+        "--ckpt-keep-last",
+        default=1,
+        type=int,
+        help="Number of most recent checkpoints to keep (at least 1).",
+    )
+    parser.add_argument(
+        "--ckpt-keep-every",
+        default=0,
+        type=int,
+        help="Also keep every checkpoint whose step is a multiple of this (0 to disable).",
+    )
+    parser.add_argument(
+        "--ckpt-storage",
+        default="shared",
+        choices=["shared", "local"],
+        help="Whether --save-dir is on storage shared by every node (rank 0 commits the checkpoints) or on each node's local disk (local rank 0 of every node commits its own).",
+    )
     parser.add_argument("-s", "--seq-length", default=None, type=int)
+    parser.add_argument(
+        "--packing",
+        default="concat",
+        choices=["concat", "best-fit"],
+        help="concat splits the concatenated documents into blocks. best-fit packs whole documents into blocks (with a little padding), and each document only attends to itself with flash_attention_2.",
+    )
+    parser.add_argument(
+        "--preprocess-workers",
+        default=None,
+        type=int,
+        help="Number of processes used to tokenize the dataset. Defaults to every core we can run on.",
+    )
+    parser.add_argument(
+        "--streaming",
+        default="off",
+        choices=["on", "off"],
+        help="Tokenize & pack the dataset on the fly, instead of preprocessing all of it before training.",
+    )
+    parser.add_argument(
+        "--shuffle-buffer",
+        default=1000,
+        type=int,
+        help="Number of blocks shuffled together when streaming.",
+    )
+    parser.add_argument(
+        "--steps-per-epoch",
+        default=1000,
+        type=int,
+        help="Only used when streaming, since a stream has no length.",
+    )
+    parser.add_argument(
+        "--async-ckpt",
+        default="off",
+        choices=["on", "off"],
+        help="Write checkpoints in a background thread while training continues.",
+    )
+    parser.add_argument(
+        "--compile",
+        default="off",
+        choices=["on", "off"],
+        help="torch.compile each decoder layer.",
+    )
+    parser.add_argument(
+        "--compile-cache-dir",
+        default=None,
+        help="Where torch.compile caches compiled kernels, ideally on node-local disk. Defaults to torch's own temporary directory.",
+    )
+    parser.add_argument(
+        "--profile",
+        default="off",
+        choices=["on", "off"],
+        help="Record a torch.profiler trace of a few steps, and log a summary of the time spent in each collective.",
+    )
+    parser.add_argument(
+        "--profile-start",
+        default=10,
+        type=int,
+        help="The step to start profiling at.",
+    )
+    parser.add_argument(
+        "--profile-steps",
+        default=5,
+        type=int,
+        help="How many steps to profile.",
+    )
+    parser.add_argument(
+        "--profile-ranks",
+        default=[0],
+        type=int,
+        nargs="+",
+        help="The ranks that record a trace. Only rank 0 logs to wandb, the others just log their summary.",
+    )
+    parser.add_argument(
+        "--peak-tflops",
+        default=989.0,
+        type=float,
+        help="Peak TFLOPs of a single GPU, for MFU & HFU. The default is a H100 SXM's dense bf16 peak.",
+    )
+    parser.add_argument(
+        "--straggler-threshold",
+        default=0.1,
+        type=float,
+        help="Warn about ranks that are slower than the median rank in some phase by more than this fraction of a step.",
+    )
+    parser.add_argument(
+        "--straggler-patience",
+        default=3,
+        type=int,
+        help="How many logs in a row a rank has to be slow before we warn about it.",
+    )
     return parser
 
 
@@ -0,0 +1,86 @@
+import argparse
+import logging
+
+import torch
+from torch import distributed as dist
+from torch.distributed._composable.fsdp import fully_shard
+from torch.distributed._tensor import DTensor
+from torch.distributed.elastic.multiprocessing.errors import record
+from transformers import AutoModelForCausalLM, LlamaConfig
+
+from train_llm import _apply_tensor_parallel, _init_weights
+
+LOGGER = logging.getLogger(__name__)
+
+
+@record
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tp", default=2, type=int)
+    parser.add_argument(
+        "--tile-size",
+        default=24,
+        type=int,
+        help="Small, and not a power of 2, so shards start & end in the middle of tiles.",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    dist.init_process_group(backend="gloo")
+
+    rank = dist.get_rank()
+    world_size = dist.get_world_size()
+    assert args.tp > 1
+    assert world_size % args.tp == 0
+
+    # NOTE: same layout as train_llm.py (without pipelining), just on CPU.
+    dp = world_size // args.tp
+    mesh = dist.device_mesh.init_device_mesh(
+        "cpu", (dp, args.tp), mesh_dim_names=("dp", "tp")
+    )
+    LOGGER.info(f"{rank=} {dp=} tp={args.tp}")
+
+    # NOTE: FSDP+TP needs evenly divisible shards, hence the sizes of our toy model.
+    config = LlamaConfig(
+        vocab_size=128,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        use_cache=False,
+    )
+
+    model = _build(config)
+    _apply_tensor_parallel(model, mesh["tp"], local_logits=False)
+    for layer in model.model.layers:
+        fully_shard(layer, mesh=mesh["dp"])
+    fully_shard(model, mesh=mesh["dp"])
+    # NOTE: fully_shard needs CUDA for forward/backward, but not to create & fill its shards.
+    model = model.to_empty(device="cpu")
+    _init_weights(model, seed=0, tile_size=args.tile_size)
+
+    ref_model = _build(config).to_empty(device="cpu")
+    _init_weights(ref_model, seed=0, tile_size=args.tile_size)
+
+    expected = dict(ref_model.named_parameters())
+    for name, param in model.named_parameters():
+        assert isinstance(param, DTensor), name
+        torch.testing.assert_close(param.full_tensor(), expected[name], rtol=0, atol=0)
+    LOGGER.info(
+        f"{len(expected)} parameters on {dp=} tp={args.tp} match the unsharded init"
+    )
+
+    dist.destroy_process_group()
+
+
+def _build(config):
+    with torch.device("meta"):
+        return AutoModelForCausalLM.from_config(
+            config, torch_dtype=torch.float32, attn_implementation="sdpa"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import argparse
+import logging
+from unittest import mock
+
+import torch
+from torch import distributed as dist
+from torch.distributed._tensor import DTensor
+from torch.distributed.pipelining import schedules
+from torch.distributed.elastic.multiprocessing.errors import record
+import torch.distributed.tensor.parallel as tp
+from transformers import AutoModelForCausalLM, LlamaConfig
+
+from train_llm import (
+    _apply_tensor_parallel,
+    _build_pipeline_schedule,
+    _init_weights,
+    _pipeline_loss,
+    _split_into_pipeline_stages,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+
+@record
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pp", default=2, type=int)
+    parser.add_argument("--tp", default=2, type=int)
+    parser.add_argument(
+        "--pp-schedule", default="1f1b", choices=["1f1b", "interleaved-1f1b"]
+    )
+    parser.add_argument("--pp-microbatches", default=4, type=int)
+    parser.add_argument("--batch-size", default=4, type=int)
+    parser.add_argument("--grad-accum", default=1, type=int)
+    parser.add_argument("--seq-length", default=32, type=int)
+    parser.add_argument("--num-steps", default=3, type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    dist.init_process_group(backend="gloo")
+
+    rank = dist.get_rank()
+    world_size = dist.get_world_size()
+    assert args.tp > 1
+    assert world_size % (args.pp * args.tp) == 0
+    assert args.batch_size % args.pp_microbatches == 0
+
+    # NOTE: same layout as train_llm.py, just on CPU.
+    dp = world_size // (args.pp * args.tp)
+    mesh = dist.device_mesh.init_device_mesh(
+        "cpu", (args.pp, dp, args.tp), mesh_dim_names=("pp", "dp", "tp")
+    )
+    LOGGER.info(f"{rank=} pp={args.pp} {dp=} tp={args.tp}")
+
+    config = LlamaConfig(
+        vocab_size=128,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=4,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        use_cache=False,
+    )
+    stages_per_rank = 2 if args.pp_schedule == "interleaved-1f1b" else 1
+
+    model = _build(config)
+    pp_stage_modules = _split_into_pipeline_stages(
+        model, mesh["pp"], stages_per_rank=stages_per_rank
+    )
+    # NOTE: fully_shard needs CUDA to run forward/backward, so dp is plain data parallel here:
+    #       we average the gradients over dp ourselves.
+    for part in pp_stage_modules.values():
+        _apply_tensor_parallel(part, mesh["tp"], local_logits=True)
+    model = model.to_empty(device="cpu")
+    _init_weights(model, seed=0)
+    optimizer = torch.optim.SGD(model.parameters(), lr=1.0)
+
+    # NOTE: same as train_llm.py, all of a step's micro batches go through the pipeline in a
+    #       single schedule step.
+    pp_microbatches = args.pp_microbatches * args.grad_accum
+    num_targets = args.batch_size * args.grad_accum * (args.seq_length - 1)
+
+    def pp_loss_fn(logits, labels):
+        return _pipeline_loss(
+            logits, labels, tp_mesh=mesh["tp"], total_targets=num_targets
+        )
+
+    pp_schedule, pp_stages = _build_pipeline_schedule(
+        pp_stage_modules,
+        schedule=args.pp_schedule,
+        num_microbatches=pp_microbatches,
+        loss_fn=pp_loss_fn,
+        pp_mesh=mesh["pp"],
+        tp_size=args.tp,
+        batch_size=args.batch_size * args.grad_accum,
+        seq_length=args.seq_length,
+        config=config,
+        dtype=torch.float32,
+        device=torch.device("cpu"),
+    )
+
+    # NOTE: the reference is the whole model on every rank, trained on the whole batch (all of
+    #       the dp shards, and all of the micro batches) without any parallelism.
+    ref_model = _build(config)
+    ref_model = ref_model.to_empty(device="cpu")
+    _init_weights(ref_model, seed=0)
+    ref_optimizer = torch.optim.SGD(ref_model.parameters(), lr=1.0)
+
+    dp_rank = mesh["dp"].get_local_rank()
+    for step in range(args.num_steps):
+        g = torch.Generator().manual_seed(step)
+        input_ids = torch.randint(
+            config.vocab_size,
+            (args.grad_accum, dp * args.batch_size, args.seq_length),
+            generator=g,
+        )
+        position_ids = torch.arange(args.seq_length).expand_as(input_ids)
+
+        ref_loss = ref_model(
+            input_ids.flatten(0, 1),
+            position_ids=position_ids.flatten(0, 1),
+            labels=input_ids.flatten(0, 1),
+        ).loss
+        ref_loss.backward()
+        ref_optimizer.step()
+        ref_optimizer.zero_grad(set_to_none=True)
+
+        # NOTE: this dp rank's share of each of the step's batches, one after the other.
+        shard = slice(dp_rank * args.batch_size, (dp_rank + 1) * args.batch_size)
+        local_input_ids = input_ids[:, shard].flatten(0, 1)
+        for part in pp_stage_modules.values():
+            part.position_ids = list(
+                position_ids[:, shard].flatten(0, 1).tensor_split(pp_microbatches)
+            )
+        losses = []
+        # NOTE: torch 2.5's schedules only wait on the last of the works batch_isend_irecv returns,
+        #       which isn't enough with gloo. See _batch_p2p.
+        with tp.loss_parallel(), mock.patch.object(schedules, "_batch_p2p", _batch_p2p):
+            pp_schedule.step(local_input_ids, target=local_input_ids, losses=losses)
+        for p in model.parameters():
+            grad = p.grad.to_local() if isinstance(p.grad, DTensor) else p.grad
+            dist.all_reduce(grad, group=mesh["dp"].get_group())
+            grad /= dp
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+
+        # NOTE: only the last stage computes the loss. Every dp shard has the same number of
+        #       targets, so the loss of the whole batch is the average over dp.
+        if pp_stages[-1].is_last:
+            loss = sum(losses).detach().full_tensor()
+            dist.all_reduce(loss, group=mesh["dp"].get_group())
+            loss /= dp
+            torch.testing.assert_close(loss, ref_loss.detach(), rtol=1e-4, atol=1e-4)
+            LOGGER.info(f"{step=} loss={loss.item():.5f} ref={ref_loss.item():.5f}")
+
+    LOGGER.info(
+        f"{args.pp_schedule} on pp={args.pp} {dp=} tp={args.tp} with {pp_microbatches} micro batches (grad_accum={args.grad_accum}) - all match"
+    )
+
+    # NOTE: other ranks' last sends may still be in flight, and gloo hangs if we tear down under them.
+    dist.barrier()
+    dist.destroy_process_group()
+
+
+def _build(config):
+    with torch.device("meta"):
+        return AutoModelForCausalLM.from_config(
+            config, torch_dtype=torch.float32, attn_implementation="sdpa"
+        )
+
+
+def _batch_p2p(p2p_ops, desc=None):
+    # NOTE: stands in for torch.distributed.pipelining.schedules._batch_p2p (torch 2.5) while the
+    #       toy runs. With gloo, batch_isend_irecv returns one work per op, but the schedules only
+    #       wait on the last one of them (NCCL coalesces a batch into a single work). So we return
+    #       something that waits on all of them.
+    works = [op.op(op.tensor, op.peer, op.group, op.tag) for op in p2p_ops]
+    return _Works(works) if works else None
+
+
+class _Works:
+    def __init__(self, works):
+        self.works = works
+
+    def wait(self):
+        for work in self.works:
+            work.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+"""
+A stand-in for nvidia-smi, to try out top-cluster.py without a cluster:
+
+    python top-cluster.py --ssh "env HOST={host} sh -c" --nvidia-smi "python fake-nvidia-smi.py" hosts
+
+Prints random stats for $FAKE_NUM_GPUS GPUs (8 by default). Hosts starting with `dead` never
+answer, to see what a stale host looks like.
+"""
+
+import argparse
+import os
+import random
+import time
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--query-gpu", default=None)
+parser.add_argument("--query-compute-apps", default=None)
+parser.add_argument("--format", default=None)
+args = parser.parse_args()
+
+if os.environ.get("HOST", "").startswith("dead"):
+    while True:
+        time.sleep(60)
+
+num_gpus = int(os.environ.get("FAKE_NUM_GPUS", "8"))
+for gpu in range(num_gpus):
+    if args.query_gpu is not None:
+        util = random.choice([0, 100])
+        power_draw = random.uniform(600, 700) if util else random.uniform(60, 80)
+        memory_used = random.uniform(70000, 80000)
+        print(f"{util}, {power_draw:.2f}, 700.00, {memory_used:.0f}, 81559")
+    elif args.query_compute_apps is not None:
+        print(1000 + gpu)
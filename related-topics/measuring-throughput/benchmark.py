@@ -0,0 +1,166 @@
+import argparse
+import logging
+import time
+
+import torch
+from transformers import AutoConfig, AutoModelForCausalLM
+
+LOGGER = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model-name", default=None, required=True)
+    parser.add_argument("-b", "--batch-size", default=1, type=int)
+    parser.add_argument("-s", "--seq-length", default=1024, type=int)
+    parser.add_argument("--num-steps", default=200, type=int)
+    parser.add_argument("--log-freq", default=50, type=int)
+    parser.add_argument("--warmup-steps", default=10, type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format=f"[%(asctime)s] %(levelname)s:%(message)s",
+        level=logging.INFO,
+    )
+
+    LOGGER.info(args)
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    dtype = torch.bfloat16
+
+    config = AutoConfig.from_pretrained(args.model_name, use_cache=False)
+    with device:
+        model = AutoModelForCausalLM.from_config(config, torch_dtype=dtype)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=3e-5)
+
+    # NOTE: random tokens, since we only care about speed here.
+    input_ids = torch.randint(
+        0, config.vocab_size, (args.batch_size, args.seq_length), device=device
+    )
+    batch = {"input_ids": input_ids, "labels": input_ids}
+
+    results = {}
+    for mode in ["sync", "events"]:
+        results[mode] = _benchmark(model, optimizer, batch, device, mode, args)
+        LOGGER.info(f"{mode}: {results[mode]}")
+
+    print(f"{'mode':>8} | {'reported tok/s':>15} | {'wall clock tok/s':>17}")
+    for mode, (reported, actual) in results.items():
+        print(f"{mode:>8} | {reported:>15.1f} | {actual:>17.1f}")
+
+
+def _benchmark(model, optimizer, batch, device, mode, args):
+    """
+    Runs the same loop as our training scripts, and returns the average tok/s that the timers
+    reported, along with the actual tok/s measured around the whole loop.
+
+    mode="sync" is how the training scripts used to work: synchronizing around every timed
+    block and calling `.item()` on the loss every step.
+    """
+    timers = {
+        k: LocalTimer(device, sync=mode == "sync")
+        for k in ["data", "forward", "backward", "update"]
+    }
+    running_loss = torch.tensor(0.0, device=device)
+    tok_per_step = args.batch_size * args.seq_length
+
+    def step():
+        with timers["data"], torch.no_grad():
+            # NOTE: a copy, standing in for moving the batch to the GPU.
+            inputs = {k: v.clone() for k, v in batch.items()}
+
+        with timers["forward"]:
+            outputs = model(**inputs)
+
+        with timers["backward"]:
+            optimizer.zero_grad(set_to_none=True)
+            outputs.loss.backward()
+
+        with timers["update"]:
+            optimizer.step()
+
+        if mode == "sync":
+            return outputs.loss.item()
+        return outputs.loss.detach()
+
+    for _ in range(args.warmup_steps):
+        step()
+    for t in timers.values():
+        t.reset()
+
+    reported = []
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start_time = time.time()
+    for i_step in range(1, args.num_steps + 1):
+        running_loss += step()
+        if i_step % args.log_freq == 0:
+            ms_per_step = sum(t.avg_elapsed_ms() for t in timers.values())
+            reported.append(1000 * tok_per_step / ms_per_step)
+            LOGGER.info(
+                f"{mode} step={i_step} running_loss={running_loss.item() / args.log_freq:.3f} tok/s={reported[-1]:.1f}"
+            )
+            running_loss.zero_()
+            for t in timers.values():
+                t.reset()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    elapsed = time.time() - start_time
+
+    return sum(reported) / len(reported), args.num_steps * tok_per_step / elapsed
+
+
+class LocalTimer:
+    """
+    Same as the one in our training scripts.
+    """
+
+    def __init__(self, device: torch.device, sync: bool = False):
+        if device.type == "cpu":
+            self.synchronize = lambda: torch.cpu.synchronize(device=device)
+        elif device.type == "cuda":
+            self.synchronize = lambda: torch.cuda.synchronize(device=device)
+        # NOTE: there is nothing asynchronous to wait for on CPU, so we just read the clock.
+        self.use_events = device.type == "cuda" and not sync
+        self.sync = sync
+        self.measurements = []
+        self.pending_events = []
+        self.start = None
+
+    def __enter__(self):
+        if self.use_events:
+            self.start = torch.cuda.Event(enable_timing=True)
+            self.start.record()
+        else:
+            if self.sync:
+                self.synchronize()
+            self.start = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if traceback is None:
+            if self.use_events:
+                end = torch.cuda.Event(enable_timing=True)
+                end.record()
+                self.pending_events.append((self.start, end))
+            else:
+                if self.sync:
+                    self.synchronize()
+                self.measurements.append(1000 * (time.time() - self.start))
+        self.start = None
+
+    def avg_elapsed_ms(self):
+        if len(self.pending_events) > 0:
+            self.pending_events[-1][1].synchronize()
+            self.measurements.extend(s.elapsed_time(e) for s, e in self.pending_events)
+            self.pending_events = []
+        return sum(self.measurements) / len(self.measurements)
+
+    def reset(self):
+        self.measurements = []
+        self.pending_events = []
+        self.start = None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import argparse
+import logging
+from pathlib import Path
+
+import torch
+from torch import distributed as dist
+import torch.distributed.checkpoint as DCP
+from torch.distributed._composable.fsdp import fully_shard
+from torch.distributed.checkpoint.state_dict import (
+    StateDictOptions,
+    get_state_dict,
+    set_state_dict,
+)
+from torch.distributed.elastic.multiprocessing.errors import record
+from torch.distributed.tensor import parallel as tp
+
+LOGGER = logging.getLogger(__name__)
+
+
+@record
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["save", "load"], required=True)
+    parser.add_argument("--tp", default=1, type=int)
+    parser.add_argument("--ckpt-dir", default="./toy-checkpoint")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    dist.init_process_group(backend="gloo")
+
+    rank = dist.get_rank()
+    world_size = dist.get_world_size()
+    assert world_size % args.tp == 0
+
+    # NOTE: same layout as 07-2d-parallel, just on CPU. With --tp 1 this is just FSDP.
+    #       FSDP+TP needs evenly divisible shards, hence the sizes of our toy model.
+    mesh = dist.device_mesh.init_device_mesh(
+        "cpu", (world_size // args.tp, args.tp), mesh_dim_names=("dp", "tp")
+    )
+    LOGGER.info(f"{rank=} dp_size={mesh['dp'].size()} tp_size={mesh['tp'].size()}")
+
+    model, optimizer = _build(mesh)
+    ckpt_opts = StateDictOptions(full_state_dict=False, cpu_offload=False)
+    ckpt_dir = Path(args.ckpt_dir)
+
+    if args.mode == "save":
+        _fake_step(model, optimizer, seed=0)
+        model_state, optimizer_state = get_state_dict(
+            model, optimizer, options=ckpt_opts
+        )
+        DCP.save(
+            dict(model=model_state, optimizer=optimizer_state), checkpoint_id=ckpt_dir
+        )
+
+        # NOTE: the reference is what training would look like one step after the checkpoint,
+        #       which the resumed run has to reproduce exactly.
+        _fake_step(model, optimizer, seed=1)
+        expected = _full_tensors(model)
+        if rank == 0:
+            torch.save(expected, ckpt_dir / "expected.pt")
+        LOGGER.info(f"Saved {ckpt_dir} from {world_size=} tp={args.tp}")
+    else:
+        # NOTE: get_state_dict() returns sharded tensors laid out for the *current* mesh, and DCP
+        #       reads just the slices of the checkpoint that overlap with each rank's shards.
+        #       So no rank ever holds the full model.
+        model_state, optimizer_state = get_state_dict(
+            model, optimizer, options=ckpt_opts
+        )
+        DCP.load(
+            dict(model=model_state, optimizer=optimizer_state), checkpoint_id=ckpt_dir
+        )
+        set_state_dict(
+            model,
+            optimizer,
+            model_state_dict=model_state,
+            optim_state_dict=optimizer_state,
+            options=ckpt_opts,
+        )
+
+        _fake_step(model, optimizer, seed=1)
+        actual = _full_tensors(model)
+        expected = torch.load(ckpt_dir / "expected.pt", weights_only=True)
+        for name in expected:
+            torch.testing.assert_close(actual[name], expected[name])
+        LOGGER.info(f"Resumed {ckpt_dir} on {world_size=} tp={args.tp} - all match")
+
+    dist.destroy_process_group()
+
+
+def _build(mesh):
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(
+        *[
+            torch.nn.Sequential(
+                torch.nn.Linear(48, 96, bias=False),
+                torch.nn.ReLU(),
+                torch.nn.Linear(96, 48, bias=False),
+            )
+            for _ in range(3)
+        ]
+    )
+    for block in model:
+        tp.parallelize_module(
+            block, mesh["tp"], {"0": tp.ColwiseParallel(), "2": tp.RowwiseParallel()}
+        )
+        fully_shard(block, mesh=mesh["dp"])
+    fully_shard(model, mesh=mesh["dp"])
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-2)
+    return model, optimizer
+
+
+def _fake_step(model, optimizer, *, seed):
+    # NOTE: FSDP needs CUDA to run forward/backward, so we hand out gradients directly instead.
+    #       Every rank generates the same full gradients & keeps just its own slice of them.
+    g = torch.Generator().manual_seed(seed)
+    for p in model.parameters():
+        full_grad = torch.randn(p.shape, generator=g)
+        p.grad = torch.distributed.tensor.distribute_tensor(
+            full_grad, p.device_mesh, p.placements
+        )
+    optimizer.step()
+    optimizer.zero_grad(set_to_none=True)
+
+
+def _full_tensors(model):
+    return {name: p.full_tensor() for name, p in model.named_parameters()}
+
+
+if __name__ == "__main__":
+    main()
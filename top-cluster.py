@@ -1,94 +1,152 @@
 import argparse
-import subprocess
-import time
+import asyncio
 import datetime
+import shlex
+import time
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
     "--poll-freq", default=1000, type=int, help="Frequency (in ms) to poll clusters"
 )
+parser.add_argument(
+    "--stale-after",
+    default=5000,
+    type=int,
+    help="Hosts we haven't heard from in this long (in ms) are shown as stale.",
+)
+parser.add_argument(
+    "--ssh",
+    default="ssh -o BatchMode=yes -o ConnectTimeout=10 -o ServerAliveInterval=5 -o ControlMaster=auto -o ControlPath=~/.ssh/top-cluster-%C -o ControlPersist=60 {host}",
+    help="Command to run a command on a host. {host} is replaced with the hostname.",
+)
+parser.add_argument(
+    "--nvidia-smi",
+    default="nvidia-smi",
+    help="The nvidia-smi command on the hosts. See fake-nvidia-smi.py for trying this out locally.",
+)
 parser.add_argument("hosts", help="File containing hostnames separated by newlines")
-args = parser.parse_args()
-
-with open(args.hosts) as fp:
-    hosts = list(filter(None, map(str.strip, fp.readlines())))
-
-while True:
-    procs = [
-        subprocess.Popen(
-            [
-                "ssh",
-                host,
-                "nvidia-smi",
-                "--query-gpu=utilization.gpu,power.draw,power.limit,memory.used,memory.total",
-                "--format=csv,noheader,nounits",
-                "&&",
-                "nvidia-smi",
-                "--query-compute-apps=pid",
-                "--format=csv,noheader,nounits",
-            ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-        )
-        for host in hosts
-    ]
-    for proc in procs:
-        proc.wait()
-
-    outputs = [proc.stdout.read().decode() for proc in procs]
-
-    gpu_stats = {}
-    node_stats = {
-        host: dict(util=0, power_usage=0, memory_usage=0, num_gpus=0, num_procs=0)
-        for host in hosts
-    }
-    cluster_stats = dict(util=0, power_usage=0, memory_usage=0, num_gpus=0, num_procs=0)
-    for host, output in zip(hosts, outputs):
-        gpu_stats[host] = {}
-        for gpu, stats in enumerate(output.splitlines()):
-            if "," not in stats:
-                node_stats[host]["num_procs"] += 1
-                cluster_stats["num_procs"] += 1
-                continue
 
+QUERY_GPU = "utilization.gpu,power.draw,power.limit,memory.used,memory.total"
+END_OF_POLL = "==="
+
+
+def remote_command(nvidia_smi, poll_freq_ms):
+    # NOTE: `nvidia-smi --loop` can only repeat a single query, so we loop in the remote shell
+    #       instead. This keeps one ssh connection per host open for as long as we run.
+    return (
+        f"while {nvidia_smi} --query-gpu={QUERY_GPU} --format=csv,noheader,nounits"
+        f" && {nvidia_smi} --query-compute-apps=pid --format=csv,noheader,nounits;"
+        f" do echo {END_OF_POLL}; sleep {poll_freq_ms / 1000.0}; done"
+    )
+
+
+def parse_poll(lines):
+    stats = dict(util=0, power_usage=0, memory_usage=0, num_gpus=0, num_procs=0)
+    for line in lines:
+        if "," not in line:
+            stats["num_procs"] += 1
+            continue
+        try:
             util, power_draw, power_limit, memory_used, memory_total = map(
-                float, stats.split(", ")
+                float, line.split(", ")
             )
-            power_usage = 100 * power_draw / power_limit
-            memory_usage = 100 * memory_used / memory_total
+        except ValueError:
+            # NOTE: e.g. [N/A] or [Unknown Error] for a GPU that fell off the bus.
+            continue
+        stats["util"] += util
+        stats["power_usage"] += 100 * power_draw / power_limit
+        stats["memory_usage"] += 100 * memory_used / memory_total
+        stats["num_gpus"] += 1
+    return stats
 
-            gpu_stats[host][gpu] = dict(
-                util=util, power_usage=power_usage, memory_usage=memory_usage
-            )
-            node_stats[host]["util"] += util
-            node_stats[host]["memory_usage"] += memory_usage
-            node_stats[host]["power_usage"] += power_usage
-            node_stats[host]["num_gpus"] += 1
-            cluster_stats["util"] += util
-            cluster_stats["memory_usage"] += memory_usage
-            cluster_stats["power_usage"] += power_usage
-            cluster_stats["num_gpus"] += 1
 
-    if cluster_stats["num_gpus"] > 0:
-        cluster_stats["util"] /= cluster_stats["num_gpus"]
-        cluster_stats["memory_usage"] /= cluster_stats["num_gpus"]
-        cluster_stats["power_usage"] /= cluster_stats["num_gpus"]
+async def watch_host(host, args, latest):
+    """
+    Keeps a stream of nvidia-smi output open to `host`, and puts the stats of each poll into
+    `latest[host]` as it arrives. Reconnects if the stream ends.
+    """
+    command = [part.format(host=host) for part in shlex.split(args.ssh)]
+    command.append(remote_command(args.nvidia_smi, args.poll_freq))
+    while True:
+        proc = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        lines = []
+        try:
+            async for line in proc.stdout:
+                line = line.decode().strip()
+                if line == END_OF_POLL:
+                    latest[host] = (time.monotonic(), parse_poll(lines))
+                    lines = []
+                elif line:
+                    lines.append(line)
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+            await proc.wait()
+        await asyncio.sleep(args.poll_freq / 1000.0)
+
+
+def print_stats(hosts, started, latest, stale_after_ms):
+    now = time.monotonic()
+    node_stats = {}
+    cluster_stats = dict(util=0, power_usage=0, memory_usage=0, num_gpus=0, num_procs=0)
     for host in hosts:
-        if node_stats[host]["num_gpus"] == 0:
+        if host not in latest or 1000 * (now - latest[host][0]) > stale_after_ms:
             continue
-        node_stats[host]["util"] /= node_stats[host]["num_gpus"]
-        node_stats[host]["memory_usage"] /= node_stats[host]["num_gpus"]
-        node_stats[host]["power_usage"] /= node_stats[host]["num_gpus"]
+        stats = node_stats[host] = dict(latest[host][1])
+        for key in cluster_stats:
+            cluster_stats[key] += stats[key]
+        if stats["num_gpus"] > 0:
+            for key in ["util", "power_usage", "memory_usage"]:
+                stats[key] /= stats["num_gpus"]
+
+    if cluster_stats["num_gpus"] > 0:
+        for key in ["util", "power_usage", "memory_usage"]:
+            cluster_stats[key] /= cluster_stats["num_gpus"]
 
     print(f"==={datetime.datetime.now()}")
     print(f"{'name':>10}\t{'util':>10}\t{'power':>10}\t{'memory':>10}\t{'nprocs':>10}")
     print(
         f"{'cluster':>10}\t{cluster_stats['util']:>9.1f}%\t{cluster_stats['power_usage']:>9.1f}%\t{cluster_stats['memory_usage']:>9.1f}%\t{cluster_stats['num_procs']:>10}"
     )
-    for host, stats in node_stats.items():
-        print(
-            f"{host:>10}\t{stats['util']:>9.1f}%\t{stats['power_usage']:>9.1f}%\t{stats['memory_usage']:>9.1f}%\t{stats['num_procs']:>10}"
-        )
+    for host in hosts:
+        if host in node_stats:
+            stats = node_stats[host]
+            print(
+                f"{host:>10}\t{stats['util']:>9.1f}%\t{stats['power_usage']:>9.1f}%\t{stats['memory_usage']:>9.1f}%\t{stats['num_procs']:>10}"
+            )
+        elif host in latest:
+            print(f"{host:>10}\tstale for {now - latest[host][0]:.0f}s")
+        elif 1000 * (now - started[host]) > stale_after_ms:
+            # NOTE: e.g. a host that is down, so ssh keeps timing out & reconnecting.
+            print(f"{host:>10}\tstale, no answer in {now - started[host]:.0f}s")
+        else:
+            print(f"{host:>10}\twaiting")
     print("===")
 
-    time.sleep(args.poll_freq / 1000.0)
+
+async def main():
+    args = parser.parse_args()
+
+    with open(args.hosts) as fp:
+        hosts = list(filter(None, map(str.strip, fp.readlines())))
+
+    # NOTE: every host is read concurrently, so a slow (or dead) host never holds up the others.
+    started = dict.fromkeys(hosts, time.monotonic())
+    latest = {}
+    tasks = [asyncio.create_task(watch_host(host, args, latest)) for host in hosts]
+    while True:
+        await asyncio.sleep(args.poll_freq / 1000.0)
+        for task in tasks:
+            if task.done():
+                # NOTE: watch_host only ever stops by raising, e.g. if the ssh command doesn't exist.
+                task.result()
+        print_stats(hosts, started, latest, args.stale_after)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())